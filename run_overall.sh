@@ -16,6 +16,15 @@ IMAGE_TYPE="grids"
 # Checkpoint number
 CHECKPOINT="15000"
 
+# Persistent VLM answer cache shared by alignment and text (inspect/prune with: python -m scripts.utils.answer_cache stats)
+ANSWER_CACHE="cache/vlm_answers.sqlite"
+
+# Tile validity manifest shared by all scorers, so every grid is checked for black/blank/duplicate tiles only once
+TILE_MANIFEST="cache/tile_manifest_${MODE}.jsonl"
+
+# Cached listing of the image directories, so each directory is listed once instead of once per prompt
+IMAGE_MANIFEST="cache/image_manifest.json"
+
 # model list - now includes both omni and omni-ep variants
 MODEL_NAMES=("omni" "omni-ep")
 
@@ -41,6 +50,9 @@ python -m scripts.alignment.alignment_score \
   --checkpoint "$CHECKPOINT" \
   --model_names "${MODEL_NAMES[@]}" \
   --image_grid "${IMAGE_GRID[@]}" \
+  --tile_manifest "$TILE_MANIFEST" \
+  --image_manifest "$IMAGE_MANIFEST" \
+  --answer_cache "$ANSWER_CACHE" \
   --class_items "anime" "human" "object" \
 
 # In ZH mode, the class_items list can be extended to include "multilingualism".
@@ -56,6 +68,9 @@ python -m scripts.text.text_score \
   --checkpoint "$CHECKPOINT" \
   --model_names "${MODEL_NAMES[@]}" \
   --image_grid "${IMAGE_GRID[@]}" \
+  --tile_manifest "$TILE_MANIFEST" \
+  --image_manifest "$IMAGE_MANIFEST" \
+  --answer_cache "$ANSWER_CACHE" \
 
 # Diversity Score
 
@@ -68,6 +83,8 @@ python -m scripts.diversity.diversity_score \
   --checkpoint "$CHECKPOINT" \
   --model_names "${MODEL_NAMES[@]}" \
   --image_grid "${IMAGE_GRID[@]}" \
+  --tile_manifest "$TILE_MANIFEST" \
+  --image_manifest "$IMAGE_MANIFEST" \
   --class_items "anime" "human" "object" "text" "reasoning" \
 
 # Style Score
@@ -81,6 +98,8 @@ python -m scripts.style.style_score \
   --checkpoint "$CHECKPOINT" \
   --model_names "${MODEL_NAMES[@]}" \
   --image_grid "${IMAGE_GRID[@]}" \
+  --tile_manifest "$TILE_MANIFEST" \
+  --image_manifest "$IMAGE_MANIFEST" \
 
 # Reasoning Score
 
@@ -93,6 +112,8 @@ python -m scripts.reasoning.reasoning_score \
   --checkpoint "$CHECKPOINT" \
   --model_names "${MODEL_NAMES[@]}" \
   --image_grid "${IMAGE_GRID[@]}" \
+  --tile_manifest "$TILE_MANIFEST" \
+  --image_manifest "$IMAGE_MANIFEST" \
 
 
 rm -rf tmp_*
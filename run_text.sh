@@ -15,6 +15,9 @@ IMAGE_TYPE="non-grids"
 # Checkpoint number
 CHECKPOINT="15000"
 
+# Persistent VLM answer cache shared by alignment and text (inspect/prune with: python -m scripts.utils.answer_cache stats)
+ANSWER_CACHE="cache/vlm_answers.sqlite"
+
 # model list
 MODEL_NAMES=("omni" "omni-ep")
 
@@ -32,6 +35,7 @@ python -m scripts.text.text_score \
   --checkpoint "$CHECKPOINT" \
   --model_names "${MODEL_NAMES[@]}" \
   --image_grid "${IMAGE_GRID[@]}" \
+  --answer_cache "$ANSWER_CACHE" \
 
 rm -rf tmp_*
 # end_time
@@ -1,121 +1,191 @@
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 import os
-import megfile
-import shutil
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
-from scripts.utils.utils import parse_args, split_2x2_grid, save2csv, on_rm_error, get_image_path
+from scripts.utils.utils import parse_args, save2csv, get_eval_targets
+from scripts.utils.pipeline import run_scorers, sort_records, prompt_score_frame
+from scripts.utils.profiler import span
 
-import json
-from copy import deepcopy
-from scripts.utils.inference import Qwen2_5VLBatchInferencer
+from scripts.utils.models import load_model
+from scripts.alignment.alignment_utils import LazyQuestionScheduler, filter_and_average, load_question_store
 
 import datetime
 current_time = datetime.datetime.now()
 formatted_time = current_time.strftime("%Y-%m-%d_%H-%M-%S")
 
-inferencer = Qwen2_5VLBatchInferencer("Qwen/Qwen2.5-VL-7B-Instruct")
-
-def alignment_score(img_path, questions, dependencies, img_grid, cache_dir):
-    score = {}
-    
-    if len(img_path) == 1:
-        split_img_list = split_2x2_grid(img_path[0], img_grid, cache_dir)
-        if len(split_img_list) == 0:
-            return None    
-    else:
-        return None
-    
-    for id, question in questions.items():
-        images_path = split_img_list
-        batch_answer = inferencer.infer_semantic(images_path, question)
-        score[id] = [float(ans == "Yes") for ans in batch_answer]
-        
-    filter_score = deepcopy(score)
-    for img_idx in range(len(split_img_list)):
-        for id, parent_ids in dependencies.items():
-            any_parent_answered_no = False
-            for parent_id in parent_ids:
-                if parent_id == 0:
-                    continue
-                try:
-                    if score[parent_id][img_idx] == 0:
-                        any_parent_answered_no = True
-                        break
-                    else:
-                        continue
-                except:
-                    print("The score is not a number.")
-            if any_parent_answered_no:
-                filter_score[id][img_idx] = 0
-
-    sum_of_filter_score = [0] * len(split_img_list)
-    for question_id in range(len(filter_score)):
-        for img_idx in range(len(split_img_list)):
-            sum_of_filter_score[img_idx] += filter_score[question_id + 1][img_idx]
-    
-    sum_of_filter_score = [img_score / len(filter_score) for img_score in sum_of_filter_score]
-    
-    return sum(sum_of_filter_score)  / len(sum_of_filter_score) 
-    
+def batched_alignment_scores(inferencer, jobs, batch_size, use_logits=False, lazy=True):
+    """
+    Score several grids at once by flattening their (question, tile) pairs into shared VLM batches.
+
+    Questions are asked in topological waves of the dependency graph, and children of a parent
+    that was already answered "No" on a tile are not sent to the VLM (see LazyQuestionScheduler).
+
+    Args:
+        inferencer: Qwen2_5VLBatchInferencer answering the questions
+        jobs: List of (split_img_list, CompiledQuestions); split_img_list may be None
+        batch_size: Number of (question, tile) pairs per VLM batch
+        use_logits: Answer from Yes/No next-token logits instead of decoded text
+        lazy: Skip questions whose filtered score is already known to be 0
+
+    Returns:
+        One (hard score, soft score) tuple per job, in the same order; the soft score is
+        only available with use_logits, and both are None when the grid has no tiles.
+        Also returns the number of (question, tile) queries that were skipped.
+    """
+    schedulers = [
+        LazyQuestionScheduler(entry, len(split_img_list), lazy) if split_img_list is not None else None
+        for split_img_list, entry in jobs
+    ]
+    soft_scores = [np.zeros((len(entry.ids), len(split_img_list))) if split_img_list is not None else None
+                   for split_img_list, entry in jobs]
+
+    num_waves = max([len(scheduler.waves) for scheduler in schedulers if scheduler is not None], default=0)
+    for wave_idx in range(num_waves):
+        images, texts, owners = [], [], []
+        for job_idx, ((split_img_list, entry), scheduler) in enumerate(zip(jobs, schedulers)):
+            if scheduler is None:
+                continue
+            for question_idx, tile_idx in scheduler.pending(wave_idx):
+                images.append(split_img_list[tile_idx])
+                texts.append(entry.questions[question_idx])
+                owners.append((job_idx, question_idx, tile_idx))
+
+        answers = inferencer.infer_semantic_pairs(images, texts, batch_size, use_logits=use_logits)
+
+        for (job_idx, question_idx, tile_idx), ans in zip(owners, answers):
+            if use_logits:
+                ans, p_yes = ans
+                soft_scores[job_idx][question_idx, tile_idx] = p_yes
+            schedulers[job_idx].record(question_idx, tile_idx, float(ans == "Yes"))
+
+    results = []
+    num_saved = 0
+    for (_, entry), scheduler, soft_score in zip(jobs, schedulers, soft_scores):
+        if scheduler is None:
+            results.append((None, None))
+            continue
+        num_saved += scheduler.num_saved
+        with span("alignment/filter"):
+            hard = filter_and_average(entry, scheduler.answers)
+            soft = filter_and_average(entry, scheduler.answers, soft_score) if use_logits else None
+        results.append((hard, soft))
+    return results, num_saved
+
+
+class AlignmentScorer:
+    """Alignment score of every prompt in args.class_items, answered by a shared Qwen2.5-VL inferencer."""
+    name = "alignment"
+    work_unit = "alignment queries"
+
+    def __init__(self, args, inferencer):
+        self.args = args
+        self.inferencer = inferencer
+        self.categories = list(args.class_items)
+        self.question_dependency_dir = "scripts/alignment"
+
+        self.num_targets = len(get_eval_targets(args))
+        self.use_logits = args.scoring == "logits"
+        # one record per (prompt, model), aggregated by save_results
+        self.records = []
+        # (question, tile) queries skipped by the dependency-aware scheduler, per category
+        self.saved_queries = {}
+        self.question_store = None
+        # grids waiting to be scored together: (row, label, job)
+        self.pending = []
+
+    def select(self, category, listed_keys):
+        if self.args.mode == "EN":
+            question_dependency_json_dir = self.question_dependency_dir + '/Q_D/' + category + '.json'
+        else:
+            question_dependency_json_dir = self.question_dependency_dir + '/Q_D/' + category + '_zh.json'
+        self.question_store = load_question_store(question_dependency_json_dir)
+        self.saved_queries[category] = 0
+        return list(self.question_store.keys())
+
+    def cost(self, category, key):
+        # one VLM query per question and tile
+        return len(self.question_store[key].ids)
+
+    def work(self, task, tile_counts):
+        # at most one query per question and tile; the dependency scheduling skips some of them
+        if len(tile_counts) != 1 or tile_counts[0] == 0:
+            return {}
+        return {"alignment queries": len(self.question_store[task.key].ids) * tile_counts[0]}
+
+    def score(self, task, target, grids):
+        label = target[0]
+        split_img_list = grids[0][1] if len(grids) == 1 and len(grids[0][1]) != 0 else None
+
+        self.pending.append((task, label, (split_img_list, self.question_store[task.key])))
+        if not self.args.cross_model_batch and len(self.pending) >= self.args.prompts_per_batch:
+            self.flush(task.category)
+
+        # the questions are identical across models, so all of them share the batches of this prompt
+        if self.args.cross_model_batch and task.target_id == self.num_targets - 1 and len({pending_task.key for pending_task, _, _ in self.pending}) >= self.args.prompts_per_batch:
+            self.flush(task.category)
+
+    def flush(self, category):
+        results, num_saved = batched_alignment_scores(self.inferencer, [job for _, _, job in self.pending], self.args.batch_size, self.use_logits, not self.args.ask_all_questions)
+        self.saved_queries[category] += num_saved
+        # demultiplex the shared batches back to each model/checkpoint
+        for (task, label, _), (result, soft_result) in zip(self.pending, results):
+            self.records.append({"category": task.category, "key": task.key, "label": label, "alignment": result, "alignment_soft": soft_result})
+        self.pending.clear()
+
+    def discard_pending(self):
+        self.pending.clear()
+
+    def end_category(self, category):
+        if self.pending:
+            self.flush(category)
+
+    @staticmethod
+    def save_results(args, records, categories):
+        alignment_score_csv = f"results/alignment_score_{args.mode}_{formatted_time}.csv"
+        alignment_prompt_score_csv = f"results/alignment_prompt_score_{args.mode}_{formatted_time}.csv"
+        os.makedirs(os.path.dirname(alignment_score_csv), exist_ok=True)
+
+        labels = [label for label, _, _, _ in get_eval_targets(args)]
+
+        # save the alignment score of each method
+        score_csv = pd.DataFrame(index=labels, columns=["alignment"])
+        # save the score of each prompt on each method to calculate average alignment score
+        score_of_prompt = {}
+        # soft P(Yes)-based score of each prompt, only filled with --scoring logits
+        soft_score_of_prompt = {}
+        use_logits = args.scoring == "logits"
+
+        for record in sort_records(records, categories):
+            score_of_prompt.setdefault(f"{record['category']}_{record['key']}", {})[record["label"]] = record["alignment"]
+            if use_logits:
+                soft_score_of_prompt.setdefault(f"{record['category']}_{record['key']}", {})[record["label"]] = record["alignment_soft"]
+        score_of_prompt_csv = prompt_score_frame(score_of_prompt, labels)
+        soft_score_of_prompt_csv = prompt_score_frame(soft_score_of_prompt, labels)
+
+        mean_values = score_of_prompt_csv.mean()
+        score_csv["alignment"] = mean_values.values
+        if use_logits:
+            score_csv["alignment_soft"] = soft_score_of_prompt_csv.mean().values
+        save2csv(score_csv, alignment_score_csv)
+
+        # score_of_prompt_csv = score_of_prompt_csv.sort_index()
+        # save2csv(score_of_prompt_csv, alignment_prompt_score_csv)
+
+    def finish(self):
+        for class_item, num_saved in self.saved_queries.items():
+            print(f"Dependency scheduling saved {num_saved} VLM queries for {class_item}.")
+
+        if self.inferencer.answer_cache is not None:
+            print(f"VLM answer cache: {self.inferencer.answer_cache.stats()}")
+
+        if self.inferencer.vision_cache is not None:
+            print(f"Vision embedding cache: {self.inferencer.vision_cache.stats()}")
+
 def main():
     args = parse_args()
-    
-    cache_dir = f"tmp_{formatted_time}"
-    os.makedirs(cache_dir, exist_ok=True)
-
-    question_dependency_dir = "scripts/alignment"
-    
-    alignment_score_csv = f"results/alignment_score_{args.mode}_{formatted_time}.csv"
-    alignment_prompt_score_csv = f"results/alignment_prompt_score_{args.mode}_{formatted_time}.csv"
-    os.makedirs(os.path.dirname(alignment_score_csv), exist_ok=True)
-    
-    # save the alignment score of each method
-    score_csv = pd.DataFrame(index=args.model_names, columns=["alignment"])
-    # save the score of each prompt on each method to calculate average alignment score
-    score_of_prompt_csv = pd.DataFrame(columns=args.model_names)
-    
-    for class_item in args.class_items:
-
-        print(f"We process {class_item} now.")
-
-        if args.mode == "EN":
-            question_dependency_json_dir = question_dependency_dir + '/Q_D/' + class_item + '.json'
-        else:
-            question_dependency_json_dir = question_dependency_dir + '/Q_D/' + class_item + '_zh.json'
- 
-        with open(question_dependency_json_dir, "r", encoding="utf-8") as f:
-            question_dependency = json.load(f)
-        
-        for key, item in tqdm(question_dependency.items(), desc=f"Processing {class_item}"):
-
-            if isinstance(item["question"], str):
-                item["question"] = {int(k): v for k, v in json.loads(item["question"]).items()}
-            if isinstance(item["dependency"], str):
-                item["dependency"] = {int(k): v for k, v in json.loads(item["dependency"]).items()}
-
-            for model_id, model_name in enumerate(args.model_names):
-                
-                img_grid = (args.image_grid[model_id], args.image_grid[model_id])
-                
-                # New path structure: base/model/image_type/checkpoint/language/category/
-                image_dir = get_image_path(args.image_dirname, model_name, args.image_type, args.checkpoint, args.mode, class_item)
-                image_path = megfile.smart_glob(image_dir + '/' + key + '*')
-                
-                result = alignment_score(image_path, item["question"], item["dependency"], img_grid, cache_dir)
-                
-                score_of_prompt_csv.loc[f"{class_item}_{key}", model_name] = result
-
-    mean_values = score_of_prompt_csv.mean()
-    score_csv["alignment"] = mean_values.values
-    save2csv(score_csv, alignment_score_csv)
-    
-    # score_of_prompt_csv = score_of_prompt_csv.sort_index()
-    # save2csv(score_of_prompt_csv, alignment_prompt_score_csv)
-
-    if os.path.exists(cache_dir):
-        shutil.rmtree(cache_dir, onerror=on_rm_error)
-        
+    inferencer = load_model("qwen2.5-vl", answer_cache=args.answer_cache)
+    run_scorers(args, [AlignmentScorer(args, inferencer)])
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,142 @@
+import os
+import json
+import numpy as np
+from typing import NamedTuple
+
+from scripts.utils.utils import load_compiled
+
+
+class CompiledQuestions(NamedTuple):
+    """Questions of one prompt, with adjacency[p, c] set when question p is a parent of question c."""
+    ids: np.ndarray
+    questions: list
+    adjacency: np.ndarray
+    waves: list
+
+
+def question_waves(questions, dependencies):
+    """
+    Group question ids into topological waves of the parent/child dependency graph.
+
+    Parent id 0 (no parent), self references and unknown ids are ignored. Questions
+    that are part of a dependency cycle are asked together in the last wave.
+    """
+    parents = {
+        id: {parent_id for parent_id in dependencies.get(id, []) if parent_id != 0 and parent_id != id and parent_id in questions}
+        for id in questions
+    }
+    waves = []
+    done = set()
+    remaining = set(questions)
+    while remaining:
+        wave = sorted(id for id in remaining if parents[id] <= done)
+        if not wave:
+            wave = sorted(remaining)
+        waves.append(wave)
+        done.update(wave)
+        remaining.difference_update(wave)
+    return waves
+
+
+def compile_questions(questions, dependencies):
+    ids = sorted(questions)
+    position = {id: idx for idx, id in enumerate(ids)}
+    adjacency = np.zeros((len(ids), len(ids)), dtype=bool)
+    for id, parent_ids in dependencies.items():
+        if id not in position:
+            continue
+        for parent_id in parent_ids:
+            if parent_id != 0 and parent_id in position:
+                adjacency[position[parent_id], position[id]] = True
+    waves = [np.array([position[id] for id in wave], dtype=np.int64) for wave in question_waves(questions, dependencies)]
+    return CompiledQuestions(np.array(ids, dtype=np.int64), [questions[id] for id in ids], adjacency, waves)
+
+
+def _compile_question_file(json_path):
+    with open(json_path, "r", encoding="utf-8") as f:
+        question_dependency = json.load(f)
+
+    store = {}
+    for key, item in question_dependency.items():
+        questions = item["question"]
+        dependencies = item["dependency"]
+        if isinstance(questions, str):
+            questions = json.loads(questions)
+        if isinstance(dependencies, str):
+            dependencies = json.loads(dependencies)
+        questions = {int(k): v for k, v in questions.items()}
+        dependencies = {int(k): v for k, v in dependencies.items()}
+        store[key] = compile_questions(questions, dependencies)
+    return store
+
+
+def load_question_store(json_path):
+    """
+    Load the compiled questions of a Q_D json file as {prompt id: CompiledQuestions}.
+
+    The compiled store is cached next to the json under .cache/ and rebuilt only when the json changes.
+    """
+    artifact_path = os.path.join(os.path.dirname(json_path), ".cache", os.path.basename(json_path) + ".pkl")
+    return load_compiled(json_path, artifact_path, _compile_question_file)
+
+
+def filtered_answers(entry, answers, values=None):
+    """
+    Zero every (question, tile) entry that has a parent answered "No" on that tile.
+
+    Args:
+        entry: CompiledQuestions of the prompt
+        answers: (num_questions, num_tiles) hard answers, 1.0 for "Yes" and 0.0 for "No"
+        values: Optional matrix of the same shape to filter instead of `answers` (e.g. soft P(Yes))
+    """
+    parent_no = (answers == 0).astype(np.int64)
+    any_parent_no = (entry.adjacency.T.astype(np.int64) @ parent_no) > 0
+    return np.where(any_parent_no, 0.0, answers if values is None else values)
+
+
+def filter_and_average(entry, answers, values=None):
+    """Average the filtered answers over questions and then over tiles."""
+    return float(filtered_answers(entry, answers, values).mean(axis=0).mean())
+
+
+class LazyQuestionScheduler:
+    """
+    Decide which (question, tile) pairs of one grid still need a VLM answer, wave by wave.
+
+    A question whose parent was already answered "No" on a tile is filtered to 0 anyway,
+    so it is only asked when one of its children still needs its raw answer. Skipped
+    questions are recorded as 0, which keeps the filtered scores identical to asking everything.
+    """
+    def __init__(self, entry, num_tiles, lazy=True):
+        self.entry = entry
+        self.num_tiles = num_tiles
+        self.lazy = lazy
+        self.waves = entry.waves
+        self.adjacency = entry.adjacency.astype(np.int64)
+        # NaN marks pairs that have not been answered yet
+        self.answers = np.full((len(entry.ids), num_tiles), np.nan)
+        self.num_queries = 0
+        self.num_saved = 0
+
+    def pending(self, wave_idx):
+        """Return the (question index, tile index) pairs to ask in this wave; the others are recorded as 0."""
+        if wave_idx >= len(self.waves):
+            return []
+        wave = self.waves[wave_idx]
+        if self.lazy:
+            filtered = (self.adjacency.T @ (self.answers == 0).astype(np.int64)) > 0
+            child_needs_answer = (self.adjacency[wave] @ (~filtered).astype(np.int64)) > 0
+            needed = ~filtered[wave] | child_needs_answer
+        else:
+            needed = np.ones((len(wave), self.num_tiles), dtype=bool)
+
+        skipped_rows, skipped_tiles = np.nonzero(~needed)
+        self.answers[wave[skipped_rows], skipped_tiles] = 0.0
+        self.num_saved += len(skipped_rows)
+
+        rows, tiles = np.nonzero(needed)
+        self.num_queries += len(rows)
+        return list(zip(wave[rows].tolist(), tiles.tolist()))
+
+    def record(self, question_idx, tile_idx, value):
+        self.answers[question_idx, tile_idx] = value
@@ -0,0 +1,393 @@
+"""
+CPU benchmark of the scoring pipelines.
+
+Every scorer runs its full pipeline (listing, fetching, decoding and splitting the grids, batching,
+caching, metric math and result writers) on synthetic grids, with tiny stand-in models that resize
+the tiles like the real preprocessing and answer deterministically from their pixels. Throughput and
+the per-stage breakdown are saved as JSON, so that two commits can be compared:
+
+    python -m scripts.benchmark --output results/benchmark_base.json
+    git checkout <branch>
+    python -m scripts.benchmark --output results/benchmark_head.json
+    python -m scripts.benchmark --compare results/benchmark_base.json results/benchmark_head.json
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import shutil
+import tempfile
+import contextlib
+import subprocess
+from collections import Counter
+import torch
+import numpy as np
+import pandas as pd
+import megfile
+from PIL import Image
+from scripts.utils.utils import build_parser, open_image
+from scripts.utils.pipeline import run_scorers
+from scripts.utils.image_manifest import ImageManifest
+from scripts.utils.inference import Qwen2_5VLBatchInferencer
+from scripts.utils import profiler
+from scripts.utils.profiler import span, profiled
+from scripts.utils import models
+from scripts.evaluate import METRICS, build_scorers
+
+BENCHMARK_MODELS = ["bench_a", "bench_b"]
+CATEGORIES = ["anime", "human", "object", "text", "reasoning"]
+# entry points whose import time is measured, and the modules they must not import until a metric runs
+IMPORT_TARGETS = ["scripts.evaluate", "scripts.merge", "scripts.alignment.alignment_score", "scripts.text.text_score", "scripts.diversity.diversity_score", "scripts.style.style_score", "scripts.reasoning.reasoning_score"]
+HEAVY_MODULES = ["torch", "torchvision", "transformers", "qwen_vl_utils", "dreamsim"]
+
+# model calls of the stand-in models, per model
+QUERIES = Counter()
+
+
+def _seed(*parts):
+    return zlib.crc32("/".join(str(part) for part in parts).encode("utf-8"))
+
+
+def _pixels(image, size):
+    """Resize a tile like the preprocessing of the real models and return it as floats in [0, 1]."""
+    image = open_image(image).convert("RGB").resize((size, size), Image.BICUBIC)
+    return np.asarray(image, dtype=np.float32) / 255
+
+
+class StubQwenInferencer(Qwen2_5VLBatchInferencer):
+    """Qwen2_5VLBatchInferencer with its message building, batching and answer cache, but a pixel-statistics 'model'."""
+
+    def __init__(self, model_path: str = "stub/Qwen2.5-VL", answer_cache=None):
+        # the stand-in answers are never stopped early nor drafted
+        self._init_state(model_path, answer_cache)
+
+    @profiled("qwen/preprocess")
+    def _prepare_inputs(self, messages):
+        return [
+            (_pixels(msg[0]["content"][0]["image"], 448).mean(), msg[0]["content"][1]["text"])
+            for msg in messages
+        ]
+
+    def _p_yes(self, brightness, text):
+        return float((brightness + _seed(text) / 2 ** 32) % 1)
+
+    def batch_inference(self, messages, max_new_tokens=128, **options):
+        inputs = self._prepare_inputs(messages)
+        QUERIES["qwen"] += len(messages)
+        with span("qwen/generate"):
+            outputs = []
+            for brightness, text in inputs:
+                if text == self.TEXT_PROMPT:
+                    rng = np.random.default_rng(int(brightness * 1e6))
+                    outputs.append(" ".join(f"w{word}" for word in rng.integers(0, 50, max_new_tokens // 4)))
+                else:
+                    outputs.append("Yes" if self._p_yes(brightness, text) >= 0.5 else "No")
+        return outputs
+
+    def count_tokens(self, texts):
+        return [len(text.split()) for text in texts]
+
+    def batch_yes_probability(self, messages):
+        inputs = self._prepare_inputs(messages)
+        QUERIES["qwen"] += len(messages)
+        with span("qwen/forward"):
+            return [self._p_yes(brightness, text) for brightness, text in inputs]
+
+
+class StubStyleEmbedding:
+    """Stand-in for the CSD and OneIG-StyleEncoder embeddings: a fixed random projection of the downsampled tile."""
+    span_name = None
+    ref_path = None
+
+    def __init__(self, *args, **kwargs):
+        refs = torch.load(self.ref_path, weights_only=False)
+        dim = next(iter(refs.values())).shape[-1]
+        generator = torch.Generator().manual_seed(_seed(self.ref_path))
+        self.projection = torch.randn(16 * 16 * 3, dim, generator=generator)
+
+    def get_style_embedding(self, image_path):
+        with span(self.span_name):
+            QUERIES[self.span_name] += 1
+            pixels = torch.from_numpy(_pixels(image_path, 224))
+            pooled = torch.nn.functional.adaptive_avg_pool2d(pixels.permute(2, 0, 1), 16).reshape(1, -1)
+            return torch.nn.functional.normalize(pooled @ self.projection, dim=-1)
+
+
+class StubCSDStyleEmbedding(StubStyleEmbedding):
+    span_name = "style/csd"
+    ref_path = "scripts/style/CSD_embed.pt"
+
+
+class StubSEStyleEmbedding(StubStyleEmbedding):
+    span_name = "style/se"
+    ref_path = "scripts/style/SE_embed.pt"
+
+
+class StubLLM2CLIP:
+    """Stand-in for LLM2CLIP: cosine between pooled tile pixels and a hashed bag of words."""
+
+    @profiled("reasoning/llm2clip")
+    def text_img_similarity_score(self, image_path_list, text_prompt):
+        QUERIES["reasoning/llm2clip"] += len(image_path_list)
+        text = np.zeros(48, dtype=np.float32)
+        for word in text_prompt.split():
+            text[_seed(word) % 48] += 1
+        text /= max(np.linalg.norm(text), 1e-6)
+        scores = []
+        for image_path in image_path_list:
+            pixels = _pixels(image_path, 336).reshape(4, 84, 4, 84, 3).mean(axis=(1, 3)).reshape(-1)
+            scores.append(float(pixels @ text / max(np.linalg.norm(pixels), 1e-6)))
+        return scores
+
+
+class StubDreamSimDistance:
+    """Stand-in for DreamSimDistance: cosine distance of pooled tile pixels."""
+
+    def __init__(self, device: str = "cpu"):
+        pass
+
+    def _embed(self, image):
+        pixels = torch.from_numpy(_pixels(image, 224)).permute(2, 0, 1)
+        return torch.nn.functional.adaptive_avg_pool2d(pixels, 16).reshape(1, -1)
+
+    def distance(self, image_1_path, image_2_path):
+        QUERIES["diversity/dreamsim"] += 1
+        return (1 - torch.nn.functional.cosine_similarity(self._embed(image_1_path), self._embed(image_2_path))).item()
+
+
+def install_stub_models():
+    """Register the stand-in models in place of the real backbones."""
+    models.register("qwen2.5-vl")(StubQwenInferencer)
+    models.register("csd")(StubCSDStyleEmbedding)
+    models.register("style_encoder")(StubSEStyleEmbedding)
+    models.register("llm2clip")(StubLLM2CLIP)
+    models.register("dreamsim")(StubDreamSimDistance)
+
+
+def measure_import_times(repeat=3):
+    """Time the import of every entry point in a fresh interpreter (best of `repeat`) and list the heavy modules it loaded."""
+    code = (
+        "import sys, time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start); "
+        f"print(*[name for name in {HEAVY_MODULES!r} if name in sys.modules])"
+    )
+    import_times = {}
+    for module in IMPORT_TARGETS:
+        seconds, heavy, error = [], [], None
+        for _ in range(repeat):
+            process = subprocess.run([sys.executable, "-c", code.format(module=module)], capture_output=True, text=True)
+            if process.returncode != 0:
+                error = (process.stderr.strip().splitlines() or ["unknown error"])[-1]
+                break
+            lines = process.stdout.splitlines()
+            seconds.append(float(lines[-2]))
+            heavy = lines[-1].split()
+        import_times[module] = {"seconds": min(seconds) if error is None else None, "heavy": heavy, "error": error}
+        status = error or (f"loads {' '.join(heavy)}" if heavy else "")
+        print(f"[import] {module:<36}{'' if error else f'{min(seconds):>8.3f}s'}  {status}")
+    return import_times
+
+
+def benchmark_prompt_ids(num_prompts):
+    """Prompt ids of every category that all scorers know about (anime ids have a style class)."""
+    style_df = pd.read_csv("scripts/style/style.csv", dtype=str)
+    with open("scripts/reasoning/gt_answer.json", "r", encoding="utf-8") as f:
+        reasoning_ids = sorted(json.load(f))
+    prompt_ids = {
+        "anime": sorted(style_df.loc[style_df["class"].notna(), "id"]),
+        "text": sorted(pd.read_csv("scripts/text/text_content.csv", dtype=str)["id"]),
+        "reasoning": reasoning_ids,
+    }
+    for category in ("human", "object"):
+        with open(f"scripts/alignment/Q_D/{category}.json", "r", encoding="utf-8") as f:
+            prompt_ids[category] = sorted(json.load(f))
+    return {category: ids[:num_prompts] for category, ids in prompt_ids.items()}
+
+
+def make_dataset(data_dir, grid, image_format, num_prompts, tile_size):
+    """Write synthetic grids once per layout; smooth noise keeps the file sizes close to generated images."""
+    image_type = "grids" if grid > 1 else "non-grids"
+    for model_name in BENCHMARK_MODELS:
+        for category, ids in benchmark_prompt_ids(num_prompts).items():
+            image_dir = os.path.join(data_dir, model_name, image_type, "15000", "en", category)
+            os.makedirs(image_dir, exist_ok=True)
+            for id in ids:
+                image_path = os.path.join(image_dir, f"{id}.{image_format}")
+                if os.path.exists(image_path):
+                    continue
+                rng = np.random.default_rng(_seed(model_name, category, id))
+                canvas = Image.new("RGB", (tile_size * grid, tile_size * grid))
+                for i in range(grid):
+                    for j in range(grid):
+                        tile = Image.fromarray(rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)).resize((tile_size, tile_size), Image.BICUBIC)
+                        noise = rng.normal(0, 6, (tile_size, tile_size, 3))
+                        tile = np.clip(np.asarray(tile, dtype=np.float32) + noise, 0, 255).astype(np.uint8)
+                        canvas.paste(Image.fromarray(tile), (j * tile_size, i * tile_size))
+                tmp_path = os.path.join(image_dir, f".{id}.{os.getpid()}.{image_format}")
+                canvas.save(tmp_path, format="WEBP" if image_format == "webp" else "PNG", quality=90)
+                os.replace(tmp_path, image_path)
+    return image_type
+
+
+@contextlib.contextmanager
+def simulated_remote(latency, bandwidth):
+    """Serve the local grids as if from object storage: every request pays `latency` seconds plus its size over `bandwidth` bytes/s."""
+    smart_open, smart_scandir, directory_mtime = megfile.smart_open, megfile.smart_scandir, ImageManifest.__dict__["_directory_mtime"]
+
+    def remote_open(path, mode="r", *args, **kwargs):
+        if "r" in mode and os.path.isfile(path):
+            time.sleep(latency + os.path.getsize(path) / bandwidth)
+        return smart_open(path, mode, *args, **kwargs)
+
+    def remote_scandir(path, *args, **kwargs):
+        time.sleep(latency)
+        return smart_scandir(path, *args, **kwargs)
+
+    megfile.smart_open, megfile.smart_scandir = remote_open, remote_scandir
+    # object storage has no directory mtime, so listings are never reused across runs
+    ImageManifest._directory_mtime = staticmethod(lambda image_dir: None)
+    try:
+        yield
+    finally:
+        megfile.smart_open, megfile.smart_scandir = smart_open, smart_scandir
+        ImageManifest._directory_mtime = directory_mtime
+
+
+def run_config(args, metric, grid, image_format, storage):
+    data_dir = os.path.join(args.data_dir, f"{grid}x{grid}_{image_format}")
+    image_type = make_dataset(data_dir, grid, image_format, args.num_prompts, args.tile_size)
+    records_dir = tempfile.mkdtemp(prefix="benchmark_records_")
+
+    run_args = build_parser().parse_args(args.eval_args)
+    run_args.image_dirname, run_args.image_type, run_args.model_names = data_dir, image_type, BENCHMARK_MODELS
+    run_args.image_grid = [grid] * len(BENCHMARK_MODELS)
+    # stand-in runs must not skew the estimates of --plan
+    run_args.throughput_log = None
+    run_args.records_dir, run_args.profile, run_args.profile_trace = records_dir, True, os.path.join(args.trace_dir, f"{metric}_{grid}x{grid}_{image_format}_{storage}.json")
+    run_args.class_items = [category for category in run_args.class_items if category in CATEGORIES]
+
+    run_args.metrics = [metric]
+    scorer, = build_scorers(run_args)
+    QUERIES.clear()
+    remote = simulated_remote(args.remote_latency, args.remote_bandwidth * 1e6) if storage == "remote" else contextlib.nullcontext()
+    try:
+        with remote:
+            start = time.perf_counter()
+            run_scorers(run_args, [scorer])
+            wall = time.perf_counter() - start
+    finally:
+        shutil.rmtree(records_dir, ignore_errors=True)
+
+    stages = profiler.summary()
+    images = stages.get("grid/read", (0, 0.0))[0]
+    queries = sum(QUERIES.values())
+    return {
+        "metric": metric, "grid": grid, "format": image_format, "storage": storage,
+        "images": images, "queries": queries, "wall": wall,
+        "images_per_s": images / wall, "queries_per_s": queries / wall,
+        "stages": {name: {"calls": calls, "total": total} for name, (calls, total) in stages.items()},
+    }
+
+
+def config_name(result):
+    return f"{result['metric']} {result['grid']}x{result['grid']} {result['format']} {result['storage']}"
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+
+def compare(base_path, head_path, min_share=0.01):
+    """Print the throughput of every configuration and the mean time of its main stages in two benchmark files."""
+    with open(base_path, "r", encoding="utf-8") as f:
+        base = json.load(f)
+    with open(head_path, "r", encoding="utf-8") as f:
+        head = json.load(f)
+    print(f"base: {base['revision']} ({base_path})\nhead: {head['revision']} ({head_path})")
+
+    base_imports = base.get("import_times", {})
+    for module, times in head.get("import_times", {}).items():
+        before = base_imports.get(module)
+        if before is None or before["seconds"] is None or times["seconds"] is None:
+            continue
+        heavy = f"  loads {' '.join(times['heavy'])}" if times["heavy"] else ""
+        print(f"import {module:<36}{before['seconds']:>8.3f}s{times['seconds']:>8.3f}s{times['seconds'] / before['seconds'] - 1:>+9.1%}{heavy}")
+
+    base_results = {config_name(result): result for result in base["results"]}
+    for result in head["results"]:
+        name = config_name(result)
+        if name not in base_results:
+            print(f"\n{name}: not in base")
+            continue
+        before = base_results[name]
+        print(f"\n{name}")
+        print(f"  {'':<26}{'base':>12}{'head':>12}{'change':>9}")
+        for key in ("images_per_s", "queries_per_s"):
+            if before[key]:
+                print(f"  {key:<26}{before[key]:>12.2f}{result[key]:>12.2f}{result[key] / before[key] - 1:>+9.1%}")
+        for stage, times in result["stages"].items():
+            before_times = before["stages"].get(stage)
+            if before_times is None or times["total"] < min_share * result["wall"]:
+                continue
+            before_mean = before_times["total"] / before_times["calls"] * 1000
+            mean = times["total"] / times["calls"] * 1000
+            print(f"  {stage + ' (ms)':<26}{before_mean:>12.2f}{mean:>12.2f}{mean / before_mean - 1:>+9.1%}")
+
+
+def main():
+    parser = build_parser("Benchmark the scoring pipelines on CPU with stand-in models and synthetic grids.")
+    parser.add_argument("--metrics", type=str, nargs="+", default=METRICS, choices=METRICS, help="Scorers to benchmark.")
+    parser.add_argument("--grids", type=int, nargs="+", default=[1, 2], help="Grid layouts to benchmark (1 = single images, 2 = 2x2 grids).")
+    parser.add_argument("--formats", type=str, nargs="+", default=["png", "webp"], choices=["png", "webp"], help="Image formats to benchmark.")
+    parser.add_argument("--storage", type=str, nargs="+", default=["local", "remote"], choices=["local", "remote"], help="Read the grids from local disk and/or from simulated object storage.")
+    parser.add_argument("--num_prompts", type=int, default=8, help="Synthetic prompts per category and model.")
+    parser.add_argument("--tile_size", type=int, default=1024, help="Side of each synthetic tile in pixels.")
+    parser.add_argument("--remote_latency", type=float, default=0.03, help="Seconds added to every simulated object storage request.")
+    parser.add_argument("--remote_bandwidth", type=float, default=200, help="Simulated object storage bandwidth in MB/s.")
+    parser.add_argument("--data_dir", type=str, default="cache/benchmark", help="Directory of the synthetic grids, generated on first use.")
+    parser.add_argument("--output", type=str, default=None, help="JSON file of the results (default: results/benchmark_<revision>.json).")
+    parser.add_argument("--import_time_only", action="store_true", help="Only measure the import time of the entry points.")
+    parser.add_argument("--compare", type=str, nargs=2, default=None, metavar=("BASE", "HEAD"), help="Compare two benchmark JSON files instead of running.")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    # the evaluation parameters (batch sizes, prefetch, scoring mode, ...) are passed on to every run
+    benchmark_options = {"--metrics", "--grids", "--formats", "--storage", "--num_prompts", "--tile_size", "--remote_latency", "--remote_bandwidth", "--data_dir", "--output", "--import_time_only", "--compare"}
+    args.eval_args, skip = [], False
+    for arg in sys.argv[1:]:
+        if arg.startswith("--"):
+            skip = arg.split("=")[0] in benchmark_options
+        if not skip:
+            args.eval_args.append(arg)
+
+    revision = git_revision()
+    output = args.output or f"results/benchmark_{revision or 'unknown'}.json"
+    args.trace_dir = os.path.splitext(output)[0] + "_traces"
+
+    import_times = measure_import_times()
+    install_stub_models()
+
+    results = []
+    for metric in ([] if args.import_time_only else args.metrics):
+        for grid in args.grids:
+            for image_format in args.formats:
+                for storage in args.storage:
+                    result = run_config(args, metric, grid, image_format, storage)
+                    print(f"[benchmark] {config_name(result)}: {result['images_per_s']:.2f} images/s, {result['queries_per_s']:.2f} queries/s")
+                    results.append(result)
+
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"revision": revision, "argv": sys.argv[1:], "import_times": import_times, "results": results}, f, indent=2)
+    print(f"Benchmark saved to {output}")
+
+if __name__ == "__main__":
+    main()
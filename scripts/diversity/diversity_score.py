@@ -1,100 +1,109 @@
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 import os
-import megfile
-import shutil
 import pandas as pd
-from tqdm import tqdm
-from scripts.utils.utils import parse_args, split_2x2_grid, save2csv, on_rm_error, get_image_path
+from scripts.utils.utils import parse_args, save2csv, get_eval_targets
+from scripts.utils.pipeline import run_scorers, sort_records, prompt_score_frame
+from scripts.utils.profiler import profiled
 
-import torchvision
-torchvision.disable_beta_transforms_warning()
-from dreamsim import dreamsim
+from scripts.utils.models import load_model
 
 import datetime
 current_time = datetime.datetime.now()
 formatted_time = current_time.strftime("%Y-%m-%d_%H-%M-%S")
 
-os.environ["CUDA_VISIBLE_DEVICES"] = "0"
+# keep a GPU chosen by the caller, e.g. one per shard
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "0")
 device = "cuda"
 
-model, preprocess = dreamsim(pretrained=True, device=device)
+def get_class_items(args):
+    """Categories scored for diversity: --class_items, or --diversity_class_items of the unified evaluator."""
+    if not hasattr(args, "diversity_class_items"):
+        return list(args.class_items)
+    return list(dict.fromkeys(args.diversity_class_items or args.class_items + ["text", "reasoning"]))
 
-def img_similar_score(image_1_path, image_2_path):
-    image_1 = preprocess(Image.open(image_1_path)).to(device)
-    image_2 = preprocess(Image.open(image_2_path)).to(device)
-    distance = model(image_1, image_2)     
-    return distance.item()
+class DiversityScorer:
+    """Mean pairwise DreamSim distance between the tiles of each grid, per category."""
+    name = "diversity"
+    work_unit = "dreamsim pairs"
+
+    def __init__(self, args):
+        self.args = args
+        self.categories = get_class_items(args)
+        self.model = load_model("dreamsim", device=device)
+        # one record per scored grid, aggregated by save_results
+        self.records = []
+
+    @profiled("diversity/dreamsim")
+    def img_similar_score(self, image_1_path, image_2_path):
+        return self.model.distance(image_1_path, image_2_path)
+
+    def select(self, category, listed_keys):
+        return listed_keys
+
+    def work(self, task, tile_counts):
+        return {"dreamsim pairs": sum(tile_count * (tile_count - 1) // 2 for tile_count in tile_counts)}
+
+    def score(self, task, target, grids):
+        model_name = target[0]
+        for img_path, split_img_list in grids:
+
+            if len(split_img_list) <= 1:
+                continue
+
+            score = []
+
+            for i in range(len(split_img_list)):
+                for j in range(i+1, len(split_img_list)):
+                    prob = self.img_similar_score(split_img_list[i], split_img_list[j])
+                    score.append(prob)
+
+            avg_score = sum(score)/len(score)
+
+            self.records.append({"category": task.category, "key": task.key, "label": model_name, "path": img_path, "diversity": avg_score})
+
+    def end_category(self, category):
+        pass
+
+    @staticmethod
+    def save_results(args, records, categories):
+        class_items = list(categories)
+
+        diversity_score_csv = f"results/diversity_score_{args.mode}_{formatted_time}.csv"
+        diversity_prompt_score_csv = f"results/diversity_prompt_score_{args.mode}_{formatted_time}.csv"
+        os.makedirs(os.path.dirname(diversity_score_csv), exist_ok=True)
+
+        labels = [label for label, _, _, _ in get_eval_targets(args)]
+        column_items = class_items.copy().append("total average")
+        score_csv = pd.DataFrame(index=labels, columns=column_items)
+        score_of_prompt = {}
+        diversity_score = {class_item: {label: [] for label in labels} for class_item in class_items}
+
+        for record in sort_records(records, class_items):
+            diversity_score[record["category"]][record["label"]].append(record["diversity"])
+            score_of_prompt.setdefault(f"{record['category']}_{record['path'].split('/')[-1][:3]}", {})[record["label"]] = record["diversity"]
+        score_of_prompt_csv = prompt_score_frame(score_of_prompt, labels)
+
+        for class_item in class_items:
+            for model_name in labels:
+                if len(diversity_score[class_item][model_name]) != 0:
+                    score_csv.loc[model_name, class_item] = sum(diversity_score[class_item][model_name])/len(diversity_score[class_item][model_name])
+                else:
+                    score_csv.loc[model_name, class_item] = None
+
+        mean_values = score_of_prompt_csv.mean()
+        score_csv["total average"] = mean_values.values
+        save2csv(score_csv, diversity_score_csv)
+
+        # score_of_prompt_csv = score_of_prompt_csv.sort_index()
+        # save2csv(score_of_prompt_csv, diversity_prompt_score_csv)
+
+    def finish(self):
+        pass
 
 def main():
     args = parse_args()
-    
-    cache_dir = f"tmp_{formatted_time}"
-    os.makedirs(cache_dir, exist_ok=True)
-    
-    diversity_score_csv = f"results/diversity_score_{args.mode}_{formatted_time}.csv"
-    diversity_prompt_score_csv = f"results/diversity_prompt_score_{args.mode}_{formatted_time}.csv"
-    os.makedirs(os.path.dirname(diversity_score_csv), exist_ok=True)
-
-    column_items = args.class_items.copy().append("total average")
-    score_csv = pd.DataFrame(index=args.model_names, columns=column_items)
-    score_of_prompt_csv = pd.DataFrame(columns=args.model_names)
-
-    for model_id, model_name in enumerate(args.model_names):
-        
-        print(f"It is {model_name} time.")
-        
-        img_grid = (args.image_grid[model_id], args.image_grid[model_id]) 
-
-        model_score = []
-        
-        for class_item in args.class_items:
-            
-            print(f"We process {class_item} now.")
-            
-            # New path structure: base/model/image_type/checkpoint/language/category/
-            image_dir = get_image_path(args.image_dirname, model_name, args.image_type, args.checkpoint, args.mode, class_item)
-            img_list = megfile.smart_glob(image_dir + '/*')
-            img_list = sorted(img_list)
-            
-            print(f"We fetch {len(img_list)} images.")
-            
-            diversity_score = []
-            
-            for idx, img_path in tqdm(enumerate(img_list), total=len(img_list), desc="Processing images"):
-                
-                split_img_list = split_2x2_grid(img_path, img_grid, cache_dir)
-                if len(split_img_list) <= 1:
-                    continue
-                
-                score = []
-                
-                for i in range(len(split_img_list)):
-                    for j in range(i+1, len(split_img_list)):
-                        prob = img_similar_score(split_img_list[i], split_img_list[j])
-                        score.append(prob)
-                
-                avg_score = sum(score)/len(score)
-                
-                diversity_score.append(avg_score)
-                model_score.append(avg_score)
-                
-                score_of_prompt_csv.loc[f"{class_item}_{img_path.split('/')[-1][:3]}", model_name] = avg_score
-
-            if len(diversity_score) != 0:
-                score_csv.loc[model_name, class_item] = sum(diversity_score)/len(diversity_score)
-            else:
-                score_csv.loc[model_name, class_item] = None
-
-    mean_values = score_of_prompt_csv.mean()
-    score_csv["total average"] = mean_values.values
-    save2csv(score_csv, diversity_score_csv)
-    
-    # score_of_prompt_csv = score_of_prompt_csv.sort_index()
-    # save2csv(score_of_prompt_csv, diversity_prompt_score_csv)
-
-    if os.path.exists(cache_dir):
-        shutil.rmtree(cache_dir, onerror=on_rm_error)
+    run_scorers(args, [DiversityScorer(args)])
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
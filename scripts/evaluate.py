@@ -0,0 +1,51 @@
+from scripts.utils.utils import build_parser
+from scripts.utils.pipeline import run_scorers
+from scripts.utils.models import load_model
+
+METRICS = ["alignment", "text", "diversity", "style", "reasoning"]
+
+def get_scorer_class(metric):
+    if metric == "alignment":
+        from scripts.alignment.alignment_score import AlignmentScorer
+        return AlignmentScorer
+    if metric == "text":
+        from scripts.text.text_score import TextScorer
+        return TextScorer
+    if metric == "diversity":
+        from scripts.diversity.diversity_score import DiversityScorer
+        return DiversityScorer
+    if metric == "style":
+        from scripts.style.style_score import StyleScorer
+        return StyleScorer
+    from scripts.reasoning.reasoning_score import ReasoningScorer
+    return ReasoningScorer
+
+def build_scorers(args):
+    """Create the scorers of the requested metrics, loading every backbone once (Qwen2.5-VL is shared by alignment and text)."""
+    inferencer = None
+    if "alignment" in args.metrics or "text" in args.metrics:
+        inferencer = load_model("qwen2.5-vl", answer_cache=args.answer_cache)
+
+    scorers = []
+    for metric in METRICS:
+        if metric not in args.metrics:
+            continue
+        if metric in ("alignment", "text"):
+            scorers.append(get_scorer_class(metric)(args, inferencer))
+        else:
+            scorers.append(get_scorer_class(metric)(args))
+    return scorers
+
+def add_metric_args(parser):
+    parser.add_argument("--metrics", type=str, nargs="+", default=METRICS, choices=METRICS, help="Metrics to compute; every grid is fetched and split once for all of them.")
+    parser.add_argument("--diversity_class_items", type=str, nargs="+", default=None, help="Categories scored by diversity (default: --class_items plus text and reasoning).")
+    return parser
+
+def main():
+    parser = add_metric_args(build_parser("Run several evaluation metrics in one process."))
+    args = parser.parse_args()
+
+    run_scorers(args, build_scorers(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import os
+from scripts.utils.utils import build_parser
+from scripts.utils.pipeline import get_records_path, read_records
+from scripts.utils.work_queue import WorkQueue
+from scripts.evaluate import get_scorer_class, add_metric_args
+
+def main():
+    parser = add_metric_args(build_parser("Combine the per-prompt records of every shard into the result CSVs."))
+    args = parser.parse_args()
+
+    if args.work_queue:
+        work_queue = WorkQueue(args.work_queue)
+        print(f"Work queue {args.work_queue}: {work_queue.counts()}")
+        for metric in args.metrics:
+            records = work_queue.load_records(metric)
+            # the categories the workers scored, whatever --class_items merge is given
+            categories = work_queue.load_categories(metric)
+            if not records or categories is None:
+                print(f"Skipping {metric}: no records in the work queue")
+                continue
+            print(f"Merging {len(records)} {metric} records from the work queue.")
+            get_scorer_class(metric).save_results(args, records, categories)
+        return
+
+    for metric in args.metrics:
+        records_paths = [get_records_path(args, metric, shard_id) for shard_id in range(args.num_shards)]
+        missing = [records_path for records_path in records_paths if not os.path.exists(records_path)]
+        if missing:
+            print(f"Skipping {metric}: missing shard records {missing}")
+            continue
+
+        records = []
+        categories = []
+        for records_path in records_paths:
+            header, shard_records = read_records(records_path)
+            records.extend(shard_records)
+            categories.append(header.get("categories"))
+        # the categories the shards scored, whatever --class_items merge is given
+        if None in categories or any(shard_categories != categories[0] for shard_categories in categories):
+            print(f"Skipping {metric}: the shards scored different categories {categories}")
+            continue
+        print(f"Merging {len(records)} {metric} records from {args.num_shards} shards.")
+
+        get_scorer_class(metric).save_results(args, records, categories[0])
+
+if __name__ == "__main__":
+    main()
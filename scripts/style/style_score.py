@@ -1,15 +1,11 @@
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 import os
-import megfile
-import shutil
 import pandas as pd
-from tqdm import tqdm
-from scripts.utils.utils import parse_args, split_2x2_grid, save2csv, on_rm_error, get_image_path
+from scripts.utils.utils import parse_args, save2csv, get_eval_targets
+from scripts.utils.pipeline import run_scorers, sort_records, prompt_score_frame
 
-import torch
-torch.cuda.empty_cache()
-from scripts.utils.inference import CSDStyleEmbedding, SEStyleEmbedding
+from scripts.utils.models import load_model
 
 import datetime
 current_time = datetime.datetime.now()
@@ -17,94 +13,119 @@ formatted_time = current_time.strftime("%Y-%m-%d_%H-%M-%S")
 
 style_list = ['abstract_expressionism', 'art_nouveau', 'baroque', 'chinese_ink_painting', 'cubism', 'fauvism', 'impressionism', 'line_art', 'minimalism', 'pointillism', 'pop_art', 'rococo',  'ukiyo-e', 'clay', 'crayon',  'graffiti','lego', 'comic', 'pencil_sketch', 'stone_sculpture', 'watercolor', 'celluloid', 'chibi',   'cyberpunk',  'ghibli',  'impasto', 'pixar', 'pixel_art',  '3d_rendering']
 
-def main():
-    args = parse_args()
-    cache_dir = f"tmp_{formatted_time}"
-    os.makedirs(cache_dir, exist_ok=True)
-
-    style_csv_path = "scripts/style/style.csv"
-    df = pd.read_csv(style_csv_path, dtype=str)
-    
-    CSD_Encoder = CSDStyleEmbedding(model_path="scripts/style/models/checkpoint.pth")
-    SE_Encoder = SEStyleEmbedding(pretrained_path="xingpng/OneIG-StyleEncoder")
-
-    CSD_embed_pt = "scripts/style/CSD_embed.pt"
-    CSD_ref = torch.load(CSD_embed_pt, weights_only=False)
-    SE_embed_pt = "scripts/style/SE_embed.pt"
-    SE_ref = torch.load(SE_embed_pt)
-
-    style_score_csv = f"results/style_score_{args.mode}_{formatted_time}.csv"
-    style_style_score_csv = f"results/style_style_score_{args.mode}_{formatted_time}.csv"
-    style_prompt_score_csv = f"results/style_prompt_score_{args.mode}_{formatted_time}.csv"
-    os.makedirs(os.path.dirname(style_score_csv), exist_ok=True)
-
-    score_csv = pd.DataFrame(index=args.model_names, columns=["style"])
-    score_of_style_csv = pd.DataFrame(index=args.model_names, columns=style_list)
-    score_of_prompt_csv = pd.DataFrame(columns=args.model_names)  
-    
-    for model_id, model_name in enumerate(args.model_names):
-        
-        print(f"It is {model_name} time.")
-        
-        img_grid = (args.image_grid[model_id], args.image_grid[model_id]) 
-        
-        # New path structure: base/model/image_type/checkpoint/language/anime/
-        image_dir = get_image_path(args.image_dirname, model_name, args.image_type, args.checkpoint, args.mode, "anime")
-        img_list = megfile.smart_glob(image_dir + '/*')
-        img_list = sorted(img_list)
-        
-        print(f"We fetch {len(img_list)} images.")
-        
-        style_dict = {style: [] for style in style_list}
-
-        for idx, img_path in tqdm(enumerate(img_list), total=len(img_list), desc="Processing images"):
-            
-            id = img_path.split('/')[-1][:3]
-            
-            image_style =  str(df.loc[df["id"] == id, "class"].values[0])
+class StyleScorer:
+    """Style score of the stylized anime prompts, from CSD and OneIG-StyleEncoder embeddings."""
+    name = "style"
+    work_unit = "style embeddings"
+
+    def __init__(self, args):
+        self.args = args
+        self.categories = ["anime"]
+
+        style_csv_path = "scripts/style/style.csv"
+        self.df = pd.read_csv(style_csv_path, dtype=str)
+
+        self.CSD_Encoder = load_model("csd", model_path="scripts/style/models/checkpoint.pth")
+        self.SE_Encoder = load_model("style_encoder", pretrained_path="xingpng/OneIG-StyleEncoder")
+
+        # imported here so that loading this module stays cheap
+        import torch
+
+        CSD_embed_pt = "scripts/style/CSD_embed.pt"
+        self.CSD_ref = torch.load(CSD_embed_pt, weights_only=False)
+        SE_embed_pt = "scripts/style/SE_embed.pt"
+        self.SE_ref = torch.load(SE_embed_pt)
+
+        self.image_styles = {}
+        # one record per (prompt, model), aggregated by save_results
+        self.records = []
+
+    def select(self, category, listed_keys):
+        # only grids of stylized prompts are scored, so only those are fetched and split
+        for id in listed_keys:
+            image_style = str(self.df.loc[self.df["id"] == id, "class"].values[0])
             if (image_style[:3] == "nan"):
                 continue
-            else:
-                image_style = image_style.lower().replace(' ', '_')
-            
-            split_img_list = split_2x2_grid(img_path, img_grid, cache_dir)
-
-            CSD_ref_embeds = CSD_ref[image_style]
-            SE_ref_embeds = SE_ref[image_style]
-            
+            self.image_styles[id] = image_style.lower().replace(' ', '_')
+        return list(self.image_styles)
+
+    def work(self, task, tile_counts):
+        # one CSD and one OneIG-StyleEncoder embedding per tile
+        return {"style embeddings": 2 * sum(tile_counts)}
+
+    def score(self, task, target, grids):
+        model_name = target[0]
+        for img_path, split_img_list in grids:
+
+            id = img_path.split('/')[-1][:3]
+            image_style = self.image_styles[id]
+
+            CSD_ref_embeds = self.CSD_ref[image_style]
+            SE_ref_embeds = self.SE_ref[image_style]
+
             score = []
             for num, split_img_path in enumerate(split_img_list):
-                
-                CSD_embed = CSD_Encoder.get_style_embedding(split_img_path)
-                SE_embed = SE_Encoder.get_style_embedding(split_img_path)
-                
-                CSD_max_style_score = max(torch.max(CSD_embed @ CSD_ref_embeds.T).item(), 0)
-                SE_max_style_score = max(torch.max(SE_embed @ SE_ref_embeds.T).item(), 0)
-                
+
+                CSD_embed = self.CSD_Encoder.get_style_embedding(split_img_path)
+                SE_embed = self.SE_Encoder.get_style_embedding(split_img_path)
+
+                CSD_max_style_score = max((CSD_embed @ CSD_ref_embeds.T).max().item(), 0)
+                SE_max_style_score = max((SE_embed @ SE_ref_embeds.T).max().item(), 0)
+
                 max_style_score = (CSD_max_style_score + SE_max_style_score) / 2
                 score.append(max_style_score)
-            
-            if len(score) != 0:
-                score_of_prompt_csv.loc[id, model_name] = sum(score)/len(score)
-                style_dict[image_style].append(sum(score)/len(score))
-            else:
-                score_of_prompt_csv.loc[id, model_name] = None        
-                    
-        for style in style_list:
-            if len(style_dict[style]) != 0:
-                score_of_style_csv.loc[model_name, style] = sum(style_dict[style]) / len(style_dict[style])
-
-    mean_values = score_of_prompt_csv.mean()
-    score_csv["style"] = mean_values.values
-    save2csv(score_csv, style_score_csv)
-    
-    # save2csv(score_of_style_csv, style_style_score_csv)
-
-    # score_of_prompt_csv = score_of_prompt_csv.sort_index()
-    # save2csv(score_of_prompt_csv, style_prompt_score_csv)    
-
-    if os.path.exists(cache_dir):
-        shutil.rmtree(cache_dir, onerror=on_rm_error)
+
+            self.records.append({
+                "category": task.category,
+                "key": id,
+                "label": model_name,
+                "path": img_path,
+                "style_class": image_style,
+                "style": sum(score)/len(score) if len(score) != 0 else None,
+            })
+
+    def end_category(self, category):
+        pass
+
+    @staticmethod
+    def save_results(args, records, categories):
+        style_score_csv = f"results/style_score_{args.mode}_{formatted_time}.csv"
+        style_style_score_csv = f"results/style_style_score_{args.mode}_{formatted_time}.csv"
+        style_prompt_score_csv = f"results/style_prompt_score_{args.mode}_{formatted_time}.csv"
+        os.makedirs(os.path.dirname(style_score_csv), exist_ok=True)
+
+        labels = [label for label, _, _, _ in get_eval_targets(args)]
+        score_csv = pd.DataFrame(index=labels, columns=["style"])
+        score_of_style_csv = pd.DataFrame(index=labels, columns=style_list)
+        score_of_prompt = {}
+        style_dict = {label: {style: [] for style in style_list} for label in labels}
+
+        for record in sort_records(records, categories):
+            score_of_prompt.setdefault(record["key"], {})[record["label"]] = record["style"]
+            if record["style"] is not None:
+                style_dict[record["label"]][record["style_class"]].append(record["style"])
+        score_of_prompt_csv = prompt_score_frame(score_of_prompt, labels)
+
+        for model_name in labels:
+            for style in style_list:
+                if len(style_dict[model_name][style]) != 0:
+                    score_of_style_csv.loc[model_name, style] = sum(style_dict[model_name][style]) / len(style_dict[model_name][style])
+
+        mean_values = score_of_prompt_csv.mean()
+        score_csv["style"] = mean_values.values
+        save2csv(score_csv, style_score_csv)
+
+        # save2csv(score_of_style_csv, style_style_score_csv)
+
+        # score_of_prompt_csv = score_of_prompt_csv.sort_index()
+        # save2csv(score_of_prompt_csv, style_prompt_score_csv)
+
+    def finish(self):
+        pass
+
+def main():
+    args = parse_args()
+    run_scorers(args, [StyleScorer(args)])
 
 if __name__ == "__main__":
     main()
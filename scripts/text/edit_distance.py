@@ -0,0 +1,81 @@
+"""
+Bit-parallel Levenshtein distance (Myers 1999, in the formulation of Hyyrö 2003).
+
+Each character of the text updates the whole DP column at once: the column is encoded as vertical
++1/-1 deltas in two bit vectors of len(pattern) bits, held in Python integers of arbitrary width, so
+a comparison costs O(len(text)) big-integer operations instead of O(len(text) * len(pattern))
+interpreted steps. Results are identical to the textbook dynamic program.
+"""
+
+
+class Pattern:
+    """A string prepared as the pattern of bit-parallel distances, e.g. a ground truth compared with many OCR outputs."""
+    __slots__ = ("text", "masks", "full", "last")
+
+    def __init__(self, text: str):
+        self.text = text
+        # masks[c] has bit i set where text[i] == c
+        self.masks = {}
+        for i, char in enumerate(text):
+            self.masks[char] = self.masks.get(char, 0) | (1 << i)
+        self.full = (1 << len(text)) - 1
+        self.last = 1 << (len(text) - 1) if text else 0
+
+    def distance(self, text: str, max_distance=None) -> int:
+        """Edit distance of `text` to the pattern, capped at max_distance + 1 when a bound is given."""
+        return _distance(self, text, max_distance)
+
+
+def _distance(pattern: Pattern, text: str, max_distance=None):
+    m, n = len(pattern.text), len(text)
+    if max_distance is not None and abs(m - n) > max_distance:
+        return max_distance + 1
+    if m == 0:
+        return n
+
+    masks, full, last = pattern.masks, pattern.full, pattern.last
+    vp, vn = full, 0
+    distance = m
+    for j, char in enumerate(text):
+        eq = masks.get(char, 0)
+        d0 = (((eq & vp) + vp) ^ vp) | eq | vn
+        hp = vn | (~(d0 | vp) & full)
+        hn = d0 & vp
+        if hp & last:
+            distance += 1
+        elif hn & last:
+            distance -= 1
+        if max_distance is not None and distance - (n - j - 1) > max_distance:
+            # each remaining character lowers the distance by at most 1
+            return max_distance + 1
+        hp = (hp << 1) | 1
+        hn = hn << 1
+        vp = (hn | ~(d0 | hp)) & full
+        vn = hp & d0 & full
+    return distance
+
+
+def levenshtein(s1: str, s2: str) -> int:
+    """Edit distance with unit insertion, deletion and substitution costs."""
+    # the shorter string is the pattern, so that the bit vectors are as narrow as possible
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+    return _distance(Pattern(s2), s1)
+
+
+def levenshtein_bounded(s1: str, s2: str, max_distance: int) -> int:
+    """
+    Edit distance if it is at most `max_distance`, otherwise max_distance + 1.
+
+    Stops as soon as the distance can no longer come back under the bound, and skips the comparison
+    when the lengths alone differ by more than the bound.
+    """
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+    return _distance(Pattern(s2), s1, max_distance)
+
+
+def levenshtein_batch(texts, reference, max_distance=None):
+    """Edit distance of each of `texts` to one `reference`, whose bit masks are built only once."""
+    pattern = reference if isinstance(reference, Pattern) else Pattern(reference)
+    return [pattern.distance(text, max_distance) for text in texts]
@@ -1,115 +1,220 @@
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 import os
-import megfile
-import shutil
 import pandas as pd
-from tqdm import tqdm
-from scripts.utils.utils import parse_args, split_2x2_grid, save2csv, on_rm_error, get_image_path
+from scripts.utils.utils import parse_args, save2csv, get_eval_targets
+from typing import NamedTuple
+from scripts.utils.pipeline import GridTask, run_scorers, sort_records, prompt_score_frame
+from scripts.utils.profiler import span
 
-from scripts.text.text_utils import preprocess_string, clean_and_remove_hallucinations, levenshtein_distance, calculate_char_match_ratio
-from scripts.utils.inference import Qwen2_5VLBatchInferencer
+from scripts.text.text_utils import preprocess_string, clean_and_remove_hallucinations, load_text_index, load_token_counts
+from scripts.utils.models import load_model
 
 import datetime
 current_time = datetime.datetime.now()
 formatted_time = current_time.strftime("%Y-%m-%d_%H-%M-%S")
 
-def main():
-    args = parse_args()
-    cache_dir = f"tmp_{formatted_time}"
-    os.makedirs(cache_dir, exist_ok=True)
-    
-    influencer = Qwen2_5VLBatchInferencer("Qwen/Qwen2.5-VL-7B-Instruct")
-    
-    if args.mode == "EN":
-        text_csv_path = "scripts/text/text_content.csv"
-        MAX_EDIT_DISTANCE = 100
-    else:
-        text_csv_path = "scripts/text/text_content_zh.csv"
-        MAX_EDIT_DISTANCE = 50
-    text_df = pd.read_csv(text_csv_path, dtype=str)
-
-    text_score_csv = f"results/text_score_{args.mode}_{formatted_time}.csv"
-    text_prompt_score_csv = f"results/text_prompt_score_{args.mode}_{formatted_time}.csv"
-    os.makedirs(os.path.dirname(text_score_csv), exist_ok=True)
-    
-    score_csv = pd.DataFrame(index=args.model_names, columns=["ED", "CR", "WAC", "text score"])
-    score_of_prompt_csv = pd.DataFrame(columns=args.model_names)
-
-    for model_id, model_name in enumerate(args.model_names):
-        
-        print(f"It is {model_name} time.")
-        
-        img_grid = (args.image_grid[model_id], args.image_grid[model_id]) 
-        
-        # New path structure: base/model/image_type/checkpoint/language/text/
-        image_dir = get_image_path(args.image_dirname, model_name, args.image_type, args.checkpoint, args.mode, "text")
-        
+
+def max_edit_distance(mode):
+    """Edit distance at which the ED of a model is capped in its text score."""
+    return 100 if mode == "EN" else 50
+
+
+def length_bucket(num_tokens, max_new_tokens, smallest=16):
+    """Upper bound (a power of two times `smallest`, at most max_new_tokens) of the expected answer length."""
+    bound = smallest
+    while bound < num_tokens and bound < max_new_tokens:
+        bound *= 2
+    return min(bound, max_new_tokens)
+
+
+class _PendingGrid(NamedTuple):
+    task: GridTask
+    label: str
+    answers: list
+
+class TextScorer:
+    """Text rendering score (ED, CR, WAC) of the text prompts, read by a shared Qwen2.5-VL inferencer."""
+    name = "text"
+    work_unit = "OCR tokens (max)"
+
+    def __init__(self, args, inferencer):
+        self.args = args
+        self.influencer = inferencer
+        self.categories = ["text"]
+
+        if args.mode == "EN":
+            self.text_csv_path = "scripts/text/text_content.csv"
+        else:
+            self.text_csv_path = "scripts/text/text_content_zh.csv"
+        # preprocessed ground truths, shared by the OCR answers of every model and tile
+        self.text_index = load_text_index(self.text_csv_path)
+        # one record per (prompt, model) holding the per-tile statistics, aggregated by save_results
+        self.records = []
+        # tiles of several grids waiting for OCR, grouped by (max_new_tokens, expected answer length):
+        # generation runs until the longest answer of a batch ends, so answers of similar length are batched together
+        self.buckets = {}
+        # number of tokens of each ground truth, the expected length of its OCR answers; loaded with the first grid
+        self.gt_tokens = None
+
+    def select(self, category, listed_keys):
+        return list(self.text_index)
+
+    def get_max_new_tokens(self, id):
+        return self.text_index[id].max_new_tokens
+
+    def cost(self, category, key):
+        # an OCR answer decodes up to max_new_tokens, roughly as long as 16 tokens per Yes/No alignment query
+        return self.get_max_new_tokens(key) / 16
+
+    def work(self, task, tile_counts):
+        if len(tile_counts) != 1 or tile_counts[0] == 0:
+            return {}
+        return {"OCR calls": tile_counts[0], "OCR tokens (max)": tile_counts[0] * self.get_max_new_tokens(task.key)}
+
+    def score(self, task, target, grids):
+        id, model_name = task.key, target[0]
+
+        if len(grids) != 1 or len(grids[0][1]) == 0:
+            self.records.append({"category": task.category, "key": id, "label": model_name, "prompt_score": None})
+            return
+
+        if self.gt_tokens is None:
+            self.gt_tokens = load_token_counts(self.text_csv_path, self.influencer.model_path, self.influencer.count_tokens)
+        max_new_tokens = self.get_max_new_tokens(id)
+        bucket_key = (max_new_tokens, length_bucket(self.gt_tokens[id], max_new_tokens))
+
+        tiles = grids[0][1]
+        pending = _PendingGrid(task, model_name, [None] * len(tiles))
+        bucket = self.buckets.setdefault(bucket_key, [])
+        bucket.extend((pending, idx, tile) for idx, tile in enumerate(tiles))
+        if len(bucket) >= self.args.ocr_batch_size:
+            self.flush(bucket_key)
+
+    def flush(self, bucket_key):
+        bucket = self.buckets.pop(bucket_key)
+        for start in range(0, len(bucket), self.args.ocr_batch_size):
+            batch = bucket[start:start + self.args.ocr_batch_size]
+            # budget of the 'length' policy: an answer this much longer than its ground truth has an edit distance of at
+            # least the cap of the text score; the cap applies to the mean ED of a model, not to each tile, so stopping is lossy
+            max_chars = [len(self.text_index[pending.task.key].preprocessed) + max_edit_distance(self.args.mode) for pending, _, _ in batch]
+            drafts = [self.text_index[pending.task.key].text for pending, _, _ in batch] if self.args.ocr_gt_draft else None
+            ocr_results = self.influencer.infer_ocr([tile for _, _, tile in batch], bucket_key[0], self.args.ocr_stopping, max_chars, preprocess_string, drafts, self.args.ocr_draft_check)
+            # route the answers back to their grids, which are scored once all of their tiles are read
+            for (pending, idx, _), ocr_result in zip(batch, ocr_results):
+                pending.answers[idx] = ocr_result
+                if idx == len(pending.answers) - 1:
+                    self.score_answers(pending.task, pending.label, pending.answers)
+
+    def discard_pending(self):
+        self.buckets.clear()
+
+    def score_answers(self, task, model_name, ocr_results):
+        id = task.key
+        gt = self.text_index[id]
+
+        text_ocr_list = clean_and_remove_hallucinations(ocr_results)
+
         edit_distances = []
         completion_ratios = []
         match_word_counts = []
         gt_word_counts = []
-        
-        for id, text_gt in tqdm(zip(text_df["id"], text_df["text_content"]), total=len(text_df), desc="Processing text"):
-            word_count = len(text_gt.split())
-            if (word_count > 60):
-                max_new_tokens = 256
-            else:
-                max_new_tokens = 128
-                
-            text_gt_preprocessed = preprocess_string(text_gt)
-            
-            img_path = megfile.smart_glob(image_dir + '/' + id + '*')
-            if len(img_path) != 1:
-                score_of_prompt_csv.loc[id, model_name] = None
-            else:
-                split_img_list = split_2x2_grid(img_path[0], img_grid, cache_dir)    
-                if  len(split_img_list) != 0:                 
-                    ocr_results = influencer.infer_ocr(split_img_list, max_new_tokens)
-                else:
-                    score_of_prompt_csv.loc[id, model_name] = None
-                
-                text_ocr_list = clean_and_remove_hallucinations(ocr_results)
-                
-                ED_score = []
-                CR_score = []
-                WAC_score = []
-                
-                for text_ocr in text_ocr_list:
-                    text_ocr_preprocessed = preprocess_string(text_ocr)
-                    
-                    edit_distance = levenshtein_distance(text_ocr_preprocessed, text_gt_preprocessed)
-                    
-                    completion_ratio = 1 if edit_distance == 0 else 0
-                    
-                    match_word_count, text_word_accuracy, gt_word_count = calculate_char_match_ratio(text_gt_preprocessed, text_ocr_preprocessed)
-                    
-                    edit_distances.append(edit_distance)
-                    completion_ratios.append(completion_ratio)
-                    match_word_counts.append(match_word_count)
-                    gt_word_counts.append(gt_word_count)
-
-                    ED_score.append(edit_distance)
-                    CR_score.append(completion_ratio)
-                    WAC_score.append(text_word_accuracy)
-
-                score_of_prompt_csv.loc[id, model_name] = [(sum(ED_score)/len(ED_score)).item(), sum(CR_score)/len(CR_score), sum(WAC_score)/len(WAC_score)]
-
-        ED = sum(edit_distances) / len(edit_distances)
-        CR = sum(completion_ratios) / len(completion_ratios)
-        WAC = sum(match_word_counts) / sum(gt_word_counts)
-        
-        score_csv.loc[model_name, "ED"] = ED
-        score_csv.loc[model_name, "CR"] = CR
-        score_csv.loc[model_name, "WAC"] = WAC
-        score_csv.loc[model_name, "text score"] = 1 - min(MAX_EDIT_DISTANCE, ED) * (1 - CR) * (1 - WAC) / MAX_EDIT_DISTANCE
-
-    save2csv(score_csv, text_score_csv)
-
-    # save2csv(score_of_prompt_csv, text_prompt_score_csv)
-
-    if os.path.exists(cache_dir):
-        shutil.rmtree(cache_dir, onerror=on_rm_error)
+        WAC_score = []
+
+        for text_ocr in text_ocr_list:
+            text_ocr_preprocessed = preprocess_string(text_ocr)
+
+            with span("text/edit_distance"):
+                edit_distance = gt.pattern.distance(text_ocr_preprocessed)
+
+            completion_ratio = 1 if edit_distance == 0 else 0
+
+            with span("text/word_match"):
+                match_word_count, text_word_accuracy, gt_word_count = gt.match(text_ocr_preprocessed)
+
+            edit_distances.append(float(edit_distance))
+            completion_ratios.append(completion_ratio)
+            match_word_counts.append(match_word_count)
+            gt_word_counts.append(gt_word_count)
+            WAC_score.append(text_word_accuracy)
+
+        self.records.append({
+            "category": task.category,
+            "key": id,
+            "label": model_name,
+            "edit_distances": edit_distances,
+            "completion_ratios": completion_ratios,
+            "match_word_counts": match_word_counts,
+            "gt_word_counts": gt_word_counts,
+            "prompt_score": [sum(edit_distances)/len(edit_distances), sum(completion_ratios)/len(completion_ratios), sum(WAC_score)/len(WAC_score)],
+        })
+
+    def end_category(self, category):
+        for bucket_key in sorted(self.buckets):
+            self.flush(bucket_key)
+
+    @staticmethod
+    def save_results(args, records, categories):
+        MAX_EDIT_DISTANCE = max_edit_distance(args.mode)
+
+        text_score_csv = f"results/text_score_{args.mode}_{formatted_time}.csv"
+        text_prompt_score_csv = f"results/text_prompt_score_{args.mode}_{formatted_time}.csv"
+        os.makedirs(os.path.dirname(text_score_csv), exist_ok=True)
+
+        labels = [label for label, _, _, _ in get_eval_targets(args)]
+        score_csv = pd.DataFrame(index=labels, columns=["ED", "CR", "WAC", "text score"])
+        score_of_prompt = {}
+
+        edit_distances = {label: [] for label in labels}
+        completion_ratios = {label: [] for label in labels}
+        match_word_counts = {label: [] for label in labels}
+        gt_word_counts = {label: [] for label in labels}
+
+        for record in sort_records(records, categories):
+            model_name = record["label"]
+            score_of_prompt.setdefault(record["key"], {})[model_name] = record["prompt_score"]
+            if record["prompt_score"] is None:
+                continue
+            edit_distances[model_name].extend(record["edit_distances"])
+            completion_ratios[model_name].extend(record["completion_ratios"])
+            match_word_counts[model_name].extend(record["match_word_counts"])
+            gt_word_counts[model_name].extend(record["gt_word_counts"])
+
+        score_of_prompt_csv = prompt_score_frame(score_of_prompt, labels)
+
+        for model_name in labels:
+            if len(edit_distances[model_name]) == 0:
+                continue
+
+            ED = sum(edit_distances[model_name]) / len(edit_distances[model_name])
+            CR = sum(completion_ratios[model_name]) / len(completion_ratios[model_name])
+            WAC = sum(match_word_counts[model_name]) / sum(gt_word_counts[model_name])
+
+            score_csv.loc[model_name, "ED"] = ED
+            score_csv.loc[model_name, "CR"] = CR
+            score_csv.loc[model_name, "WAC"] = WAC
+            score_csv.loc[model_name, "text score"] = 1 - min(MAX_EDIT_DISTANCE, ED) * (1 - CR) * (1 - WAC) / MAX_EDIT_DISTANCE
+
+        save2csv(score_csv, text_score_csv)
+
+        # save2csv(score_of_prompt_csv, text_prompt_score_csv)
+
+    def finish(self):
+        if self.args.ocr_stopping or self.args.ocr_gt_draft:
+            print(f"OCR decoding: {self.influencer.ocr_report()}")
+        if self.args.ocr_draft_check and self.influencer.ocr_report().get("answers differing from plain decoding"):
+            print("Warning: some OCR answers decoded with --ocr_gt_draft differ from plain decoding.")
+
+        if self.influencer.answer_cache is not None:
+            print(f"VLM answer cache: {self.influencer.answer_cache.stats()}")
+
+        if self.influencer.vision_cache is not None:
+            print(f"Vision embedding cache: {self.influencer.vision_cache.stats()}")
+
+def main():
+    args = parse_args()
+    influencer = load_model("qwen2.5-vl", answer_cache=args.answer_cache)
+    run_scorers(args, [TextScorer(args, influencer)])
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,16 +1,25 @@
+import os
 import re
-import numpy as np
+import pandas as pd
 from collections import Counter
+from typing import NamedTuple
+from scripts.text.edit_distance import Pattern, levenshtein
+from scripts.utils.utils import load_compiled
+
+# compiled once, since every OCR answer goes through preprocess_string
+NON_TEXT_CHARS = re.compile(r"[^\u4e00-\u9fa5a-zA-Z0-9\sàâäéèêëîïôöùûüçÀÂÄÉÈÊËÎÏÔÖÙÛÜÇ]")
+TEXT_CHARS = re.compile(r"[\u4e00-\u9fa5a-zA-Z0-9àâäéèêëîïôöùûüçÀÂÄÉÈÊËÎÏÔÖÙÛÜÇ]")
+WHITESPACE = re.compile(r'\s+')
+CHINESE_CHARS = re.compile('[\u4e00-\u9fff]')
 
 def preprocess_string(s):
-    cleaned = re.sub(r"[^\u4e00-\u9fa5a-zA-Z0-9\sàâäéèêëîïôöùûüçÀÂÄÉÈÊËÎÏÔÖÙÛÜÇ]", '', s)
+    cleaned = NON_TEXT_CHARS.sub('', s)
     if contains_chinese(cleaned):
-        pattern = re.compile(r"[\u4e00-\u9fa5a-zA-Z0-9àâäéèêëîïôöùûüçÀÂÄÉÈÊËÎÏÔÖÙÛÜÇ]")
-        s = ''.join(pattern.findall(s))
+        s = ''.join(TEXT_CHARS.findall(s))
 
         return s.strip()
 
-    normalized = re.sub(r'\s+', ' ', cleaned)  
+    normalized = WHITESPACE.sub(' ', cleaned)
 
     return normalized.strip()
 
@@ -23,42 +32,79 @@ def clean_and_remove_hallucinations(texts):
     return texts
 
 def levenshtein_distance(s1, s2):
-    matrix = np.zeros((len(s1) + 1, len(s2) + 1))
-
-    for i in range(len(s1) + 1):
-        matrix[i][0] = i
-    for j in range(len(s2) + 1):
-        matrix[0][j] = j
-    for i in range(1, len(s1) + 1):
-        for j in range(1, len(s2) + 1):
-            if s1[i - 1] == s2[j - 1]:
-                cost = 0
-            else:
-                cost = 1
-            matrix[i][j] = min(
-                matrix[i - 1][j] + 1,      # delete
-                matrix[i][j - 1] + 1,      # insert
-                matrix[i - 1][j - 1] + cost  # replace
-            )
-
-    return matrix[len(s1)][len(s2)]
+    # bit-parallel, same values as the full dynamic-programming matrix
+    return float(levenshtein(s1, s2))
 
 def contains_chinese(text):
     # check whether it contains Chinese
-    return bool(re.search('[\u4e00-\u9fff]', text))
+    return bool(CHINESE_CHARS.search(text))
+
+def match_units(text, chinese):
+    # Chinese text is matched character by character, other text word by word
+    return Counter(text) if chinese else Counter(text.split())
 
 def calculate_char_match_ratio(text_gt, ocr_str):
-    if contains_chinese(text_gt):
-        gt_counter = Counter(text_gt)
-        ocr_counter = Counter(ocr_str)
-        total_match_count = sum((gt_counter & ocr_counter).values())
-        ratio = total_match_count / len(text_gt) if len(text_gt) > 0 else 0.0
-    else:
-        words_gt = text_gt.split()
-        words_ocr = ocr_str.split()
-        gt_counter = Counter(words_gt)
-        ocr_counter = Counter(words_ocr)
-        total_match_count = sum((gt_counter & ocr_counter).values())
-        total_gt_count = len(words_gt)
-        ratio = total_match_count / total_gt_count if total_gt_count > 0 else 0.0
-    return total_match_count, ratio, sum(gt_counter.values())
+    chinese = contains_chinese(text_gt)
+    return match_ground_truth(match_units(text_gt, chinese), chinese, ocr_str)
+
+def match_ground_truth(gt_counter, chinese, ocr_str):
+    """(matched units, ratio of the ground truth units matched, ground truth units) of an OCR answer, as calculate_char_match_ratio."""
+    total_match_count = sum((gt_counter & match_units(ocr_str, chinese)).values())
+    total_gt_count = sum(gt_counter.values())
+    ratio = total_match_count / total_gt_count if total_gt_count > 0 else 0.0
+    return total_match_count, ratio, total_gt_count
+
+def ocr_token_budget(text_gt):
+    # max_new_tokens of the OCR answers of a prompt
+    return 256 if len(text_gt.split()) > 60 else 128
+
+
+class GroundTruth(NamedTuple):
+    """The text of a text prompt, preprocessed once for the OCR answers of every model and tile."""
+    text: str
+    preprocessed: str
+    chinese: bool
+    # characters (Chinese) or words of the preprocessed text, see calculate_char_match_ratio
+    counter: Counter
+    # bit masks of the preprocessed text for edit distances
+    pattern: Pattern
+    max_new_tokens: int
+
+    def match(self, ocr_preprocessed):
+        return match_ground_truth(self.counter, self.chinese, ocr_preprocessed)
+
+
+def compile_ground_truth(text):
+    preprocessed = preprocess_string(text)
+    chinese = contains_chinese(preprocessed)
+    return GroundTruth(text, preprocessed, chinese, match_units(preprocessed, chinese), Pattern(preprocessed), ocr_token_budget(text))
+
+
+def _compile_text_file(csv_path):
+    text_df = pd.read_csv(csv_path, dtype=str)
+    return {id: compile_ground_truth(text) for id, text in zip(text_df["id"], text_df["text_content"])}
+
+
+def _artifact_path(csv_path, suffix=""):
+    return os.path.join(os.path.dirname(csv_path), ".cache", os.path.basename(csv_path) + suffix + ".pkl")
+
+
+def load_text_index(csv_path):
+    """
+    Load the ground truths of text_content.csv (or text_content_zh.csv) as {prompt id: GroundTruth}.
+
+    The index is cached next to the csv under .cache/ and rebuilt only when the csv changes.
+    """
+    return load_compiled(csv_path, _artifact_path(csv_path), _compile_text_file)
+
+
+def load_token_counts(csv_path, tokenizer_name, count_tokens):
+    """
+    Number of tokens of every ground truth of `csv_path` as {prompt id: count}, counted with
+    `count_tokens(texts)` and cached per tokenizer like load_text_index.
+    """
+    def build(csv_path):
+        index = load_text_index(csv_path)
+        return dict(zip(index, count_tokens([gt.text for gt in index.values()])))
+
+    return load_compiled(csv_path, _artifact_path(csv_path, "." + re.sub(r"[^\w.-]", "_", tokenizer_name) + ".tokens"), build)
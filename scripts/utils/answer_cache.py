@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+
+
+class AnswerCache:
+    """
+    Persistent, content-addressed cache of VLM answers stored in SQLite.
+
+    Entries are keyed by (tile content hash, prompt text, VLM model id, generation settings),
+    so re-running an evaluation only pays a hash lookup for images that did not change.
+    Least recently used entries are evicted once the cache exceeds `max_entries`, down to 1% below it,
+    so that the table is only counted again after that many new entries.
+    """
+    def __init__(self, path: str, max_entries: int = 2_000_000):
+        self.path = path
+        self.max_entries = max_entries
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # several evaluation processes may share one cache file
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, model TEXT NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS answers_accessed ON answers (accessed)")
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+        # entries counted at the last prune plus those inserted since (other processes sharing the file are
+        # counted at their own prunes), so that put_many does not scan the table on every insert
+        self.num_entries = self.conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0] if max_entries is not None else 0
+
+    @staticmethod
+    def make_key(tile_hash: str, prompt: str, model_id: str, settings: dict):
+        payload = json.dumps([tile_hash, prompt, model_id, settings], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        """Return {key: answer} for the keys that are cached."""
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for start in range(0, len(unique_keys), 500):
+            chunk = unique_keys[start:start + 500]
+            rows = self.conn.execute(
+                f"SELECT key, value FROM answers WHERE key IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall()
+            found.update((key, json.loads(value)) for key, value in rows)
+        if found:
+            now = time.time()
+            self.conn.executemany("UPDATE answers SET accessed = ? WHERE key = ?", [(now, key) for key in found])
+            self.conn.commit()
+        self.hits += sum(key in found for key in keys)
+        self.misses += sum(key not in found for key in keys)
+        return found
+
+    def put_many(self, answers: dict, model_id: str):
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO answers (key, value, model, created, accessed) VALUES (?, ?, ?, ?, ?)",
+            [(key, json.dumps(value, ensure_ascii=False), model_id, now, now) for key, value in answers.items()],
+        )
+        self.conn.commit()
+        self.num_entries += len(answers)
+        if self.max_entries is not None and self.num_entries > self.max_entries:
+            self.prune(max_entries=self.max_entries - self.max_entries // 100)
+
+    def prune(self, max_entries: int = None, older_than_days: float = None, model_id: str = None):
+        """Evict entries by model, by age of last access and/or down to `max_entries`; returns the number removed."""
+        removed = 0
+        if model_id is not None:
+            removed += self.conn.execute("DELETE FROM answers WHERE model = ?", (model_id,)).rowcount
+        if older_than_days is not None:
+            cutoff = time.time() - older_than_days * 86400
+            removed += self.conn.execute("DELETE FROM answers WHERE accessed < ?", (cutoff,)).rowcount
+        if max_entries is not None:
+            count = self.conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            if count > max_entries:
+                removed += self.conn.execute(
+                    "DELETE FROM answers WHERE key IN (SELECT key FROM answers ORDER BY accessed LIMIT ?)",
+                    (count - max_entries,),
+                ).rowcount
+            self.num_entries = min(count, max_entries)
+        self.conn.commit()
+        return removed
+
+    def stats(self):
+        count, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM answers").fetchone()
+        per_model = dict(self.conn.execute("SELECT model, COUNT(*) FROM answers GROUP BY model").fetchall())
+        return {
+            "entries": count,
+            "value_bytes": size,
+            "file_bytes": os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+            "per_model": per_model,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def clear(self):
+        self.conn.execute("DELETE FROM answers")
+        self.conn.commit()
+        self.conn.execute("VACUUM")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or prune the persistent VLM answer cache.")
+    parser.add_argument("command", choices=["stats", "prune", "clear"], help="Action to run on the cache.")
+    parser.add_argument("--path", type=str, default="cache/vlm_answers.sqlite", help="Path of the SQLite cache file.")
+    parser.add_argument("--max_entries", type=int, default=None, help="prune: keep at most this many most recently used entries.")
+    parser.add_argument("--older_than_days", type=float, default=None, help="prune: drop entries not used for this many days.")
+    parser.add_argument("--model", type=str, default=None, help="prune: drop every entry produced by this VLM model id.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.path):
+        print(f"No answer cache found at {args.path}")
+        return
+
+    cache = AnswerCache(args.path, max_entries=None)
+    if args.command == "stats":
+        for name, value in cache.stats().items():
+            if name not in ("hits", "misses"):
+                print(f"{name}: {value}")
+    elif args.command == "prune":
+        removed = cache.prune(max_entries=args.max_entries, older_than_days=args.older_than_days, model_id=args.model)
+        cache.conn.execute("VACUUM")
+        print(f"Removed {removed} entries from {args.path}")
+    else:
+        cache.clear()
+        print(f"Cleared {args.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import os
+import json
+import threading
+import megfile
+
+
+class ImageManifest:
+    """
+    Cached listing of the image directories, as {directory: {prompt id: [[path, size, mtime, etag], ...]}}.
+
+    Every directory is listed with a single scandir call (one LIST request on object storage), which also
+    returns the size and mtime of each image, instead of one glob per prompt. With a `path`, listings are
+    kept in a JSON file across runs: a local directory is listed again only when its mtime changed (files
+    were added, removed or renamed); remote directories have no mtime and are listed once per run. Use
+    `refresh` after overwriting images in place.
+    """
+    def __init__(self, path: str = None, refresh: bool = False):
+        self.path = path
+        self.refresh = refresh
+        self.directories = {}
+        self.signatures = {}
+        self.validated = set()
+        self.lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.directories = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"Rebuilding {path}: {e}")
+                self.directories = {}
+
+    @staticmethod
+    def _directory_mtime(image_dir):
+        # only local directories change mtime when their entries change
+        return os.stat(image_dir).st_mtime_ns if os.path.isdir(image_dir) else None
+
+    @staticmethod
+    def _scan(image_dir):
+        grids = {}
+        for entry in sorted(megfile.smart_scandir(image_dir), key=lambda entry: entry.name):
+            if entry.name.startswith(".") or entry.is_dir():
+                continue
+            extra = entry.stat.extra
+            etag = extra.get("ETag") if isinstance(extra, dict) else None
+            grids.setdefault(entry.name[:3], []).append([entry.path, entry.stat.size, entry.stat.mtime, etag])
+        return grids
+
+    def list(self, image_dir):
+        """Return {prompt id: [image paths]} for `image_dir`, listing it only when the cached copy may be stale."""
+        with self.lock:
+            record = self.directories.get(image_dir)
+            if image_dir not in self.validated:
+                mtime = self._directory_mtime(image_dir)
+                if self.refresh or record is None or mtime is None or record["mtime"] != mtime:
+                    try:
+                        grids = self._scan(image_dir)
+                    except FileNotFoundError:
+                        grids = {}
+                    record = {"mtime": mtime, "grids": grids}
+                    self.directories[image_dir] = record
+                    self._save()
+                self.validated.add(image_dir)
+                for entries in record["grids"].values():
+                    for img_path, size, img_mtime, _ in entries:
+                        self.signatures[img_path] = [size, img_mtime]
+        return {key: [entry[0] for entry in entries] for key, entries in record["grids"].items()}
+
+    def signature(self, image_path):
+        """[size, mtime] of a listed image, or None when it was not listed in this run."""
+        return self.signatures.get(image_path)
+
+    def _save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.directories, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
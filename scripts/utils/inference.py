@@ -1,25 +1,76 @@
 import os
+import inspect
+from collections import Counter, OrderedDict
 from PIL import Image
 import torch
-torch.cuda.empty_cache()
 import torchvision
 torchvision.disable_beta_transforms_warning()
 import torchvision.transforms.functional as F
 from torchvision import transforms
-from transformers import (AutoModel, AutoProcessor, AutoTokenizer, AutoConfig,
-                            CLIPImageProcessor, CLIPVisionModelWithProjection)
+from transformers import (AutoModel, AutoProcessor, AutoTokenizer, AutoConfig, DynamicCache,
+                            CLIPImageProcessor, CLIPVisionModelWithProjection, StoppingCriteriaList,
+                            LogitsProcessorList, RepetitionPenaltyLogitsProcessor)
 from qwen_vl_utils import process_vision_info
+from scripts.utils.answer_cache import AnswerCache
+from scripts.utils.utils import tile_hash, open_image
+from scripts.utils.profiler import span, profiled
+from scripts.utils.stopping import OCRStoppingCriteria
+from scripts.utils.prompt_lookup import DraftLookupCandidateGenerator
+from scripts.utils.model_server import PER_ITEM_KWARGS
 
-os.environ["CUDA_VISIBLE_DEVICES"] = "0"
+# keep a GPU chosen by the caller, e.g. one per shard
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "0")
 torch.manual_seed(42) 
 torch.cuda.manual_seed_all(42)
 
+class VisionEmbeddingCache:
+    """Bounded LRU cache of the (grid_thw, vision-tower output) of each tile keyed by its tile_hash, with hit/miss counters."""
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        embeds = self.entries.get(key)
+        if embeds is not None:
+            self.entries.move_to_end(key)
+        return embeds
+
+    def put(self, key, embeds):
+        self.entries[key] = embeds
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
 class Qwen2_5VLBatchInferencer:
+    # first tokens of the accepted answers for logit-based Yes/No scoring (EN and ZH)
+    YES_WORDS = ["Yes", "yes", "YES", " Yes", " yes", "是"]
+    NO_WORDS = ["No", "no", "NO", " No", " no", "否", "不"]
+    TEXT_PROMPT = (
+        "Recognize the text in the image, only reply with the text content, "
+        "but avoid repeating previously mentioned content. "
+        "If no text is recognized, please reply with 'No text recognized'."
+    )
+
     def __init__(self, model_path: str = "Qwen/Qwen2.5-VL-7B-Instruct", 
                     device: str = "cuda", 
                     dtype=torch.bfloat16, 
-                    use_flash_attention: bool = True):
-        
+                    use_flash_attention: bool = True,
+                    vision_cache_size: int = 64,
+                    answer_cache=None):
+        self._init_state(model_path, answer_cache)
+
         attn_impl = "flash_attention_2" if use_flash_attention else "eager"
         
         from transformers import Qwen2_5_VLForConditionalGeneration
@@ -31,55 +82,373 @@ class Qwen2_5VLBatchInferencer:
             device_map="auto",
         )
         self.processor = AutoProcessor.from_pretrained(model_path)
+        # batches mix prompts of different lengths, so pad on the left for generation
+        self.processor.tokenizer.padding_side = "left"
         self.device = torch.device(device)
-        self.TEXT_PROMPT = (
-            "Recognize the text in the image, only reply with the text content, "
-            "but avoid repeating previously mentioned content. "
-            "If no text is recognized, please reply with 'No text recognized'."
-        )
+        self.yes_token_ids = self._answer_token_ids(self.YES_WORDS)
+        self.no_token_ids = self._answer_token_ids(self.NO_WORDS)
+        assert not set(self.yes_token_ids) & set(self.no_token_ids), "Yes and No answers share a first token."
+        # newer transformers releases can restrict the logits to the last positions themselves
+        self.supports_logits_to_keep = "logits_to_keep" in inspect.signature(self.model.forward).parameters
 
-    def batch_inference(self, messages, max_new_tokens=128):
-        texts = [
-            self.processor.apply_chat_template(msg, tokenize=False, add_generation_prompt=True)
-            for msg in messages
-        ]
-        image_inputs, video_inputs = process_vision_info(messages)
+        # every tile is asked many questions, so its visual tokens are computed once and reused
+        self.vision_cache = VisionEmbeddingCache(vision_cache_size) if vision_cache_size > 0 else None
 
-        inputs = self.processor(
-            text=texts,
-            images=image_inputs,
-            videos=video_inputs,
-            padding=True,
-            return_tensors="pt",
-        ).to(self.device)
+    def _init_state(self, model_path, answer_cache):
+        """State that does not depend on the loaded model, shared with the inferencers that run it elsewhere."""
+        self.model_path = model_path
+        # optional persistent cache of answers, given as an AnswerCache or a path to its SQLite file
+        self.answer_cache = AnswerCache(answer_cache) if isinstance(answer_cache, str) else answer_cache
+        # answers stopped early by the OCR stopping policies and the tokens they left unused, and drafting statistics
+        self.ocr_stats = Counter()
+        # only an inferencer running the model keeps vision embeddings
+        self.vision_cache = None
 
-        with torch.no_grad():
-            generated_ids = self.model.generate(**inputs, max_new_tokens=max_new_tokens)
-            generated_ids_trimmed = [
-                out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
+    def _answer_token_ids(self, words):
+        token_ids = set()
+        for word in words:
+            ids = self.processor.tokenizer.encode(word, add_special_tokens=False)
+            if ids:
+                token_ids.add(ids[0])
+        return sorted(token_ids)
+
+    def _with_answer_cache(self, messages, settings, compute_fn):
+        """
+        Serve messages from the persistent answer cache and run `compute_fn` only on the misses.
+        `settings` are the generation settings of every message, or a list with the settings of each message.
+        """
+        if self.answer_cache is None:
+            return compute_fn(messages)
+
+        tile_hashes = {}
+        keys = []
+        for idx, msg in enumerate(messages):
+            image, text = msg[0]["content"][0]["image"], msg[0]["content"][1]["text"]
+            image_id = image if isinstance(image, str) else id(image)
+            if image_id not in tile_hashes:
+                tile_hashes[image_id] = tile_hash(image)
+            message_settings = settings[idx] if isinstance(settings, list) else settings
+            keys.append(AnswerCache.make_key(tile_hashes[image_id], text, self.model_path, message_settings))
+
+        with span("cache/answers"):
+            answers = self.answer_cache.get_many(keys)
+        missing = [idx for idx, key in enumerate(keys) if key not in answers]
+        if missing:
+            computed = dict(zip([keys[idx] for idx in missing], compute_fn([messages[idx] for idx in missing])))
+            with span("cache/answers"):
+                self.answer_cache.put_many(computed, self.model_path)
+            answers.update(computed)
+        return [answers[key] for key in keys]
+
+    def _encode_tiles(self, tiles):
+        """
+        Grid and vision-tower output of each tile of `tiles`, a dict of tile_hash to a message showing the tile.
+        Only the tiles missing from the vision cache are preprocessed and encoded, in one pass.
+        """
+        vision = {}
+        missing = []
+        for key in tiles:
+            cached = self.vision_cache.get(key) if self.vision_cache is not None else None
+            if cached is None:
+                missing.append(key)
+            else:
+                vision[key] = cached
+        if self.vision_cache is not None:
+            self.vision_cache.hits += len(tiles) - len(missing)
+            self.vision_cache.misses += len(missing)
+        if missing:
+            with span("qwen/preprocess"):
+                image_inputs, _ = process_vision_info([tiles[key] for key in missing])
+                image_inputs = self.processor.image_processor(images=image_inputs, return_tensors="pt")
+            grids = image_inputs["image_grid_thw"]
+            with torch.no_grad(), span("qwen/vision"):
+                embeds = self.model.visual(
+                    image_inputs["pixel_values"].to(self.device, self.model.visual.dtype),
+                    grid_thw=grids.to(self.device),
+                )
+            merge_length = self.processor.image_processor.merge_size ** 2
+            for key, grid_thw, tile_embeds in zip(missing, grids, embeds.split((grids.prod(-1) // merge_length).tolist())):
+                vision[key] = (grid_thw, tile_embeds)
+                if self.vision_cache is not None:
+                    self.vision_cache.put(key, vision[key])
+        return vision
+
+    def _prepare_inputs(self, messages):
+        """
+        Tokenize messages showing one tile each, every distinct tile being preprocessed and encoded once.
+
+        Returns:
+            The tokenized inputs with the grid of each message's tile, and the tile embeddings of their image tokens
+        """
+        tile_hashes = {}
+        keys = []
+        tiles = {}
+        with span("qwen/preprocess"):
+            for msg in messages:
+                image = msg[0]["content"][0]["image"]
+                image_id = image if isinstance(image, str) else id(image)
+                if image_id not in tile_hashes:
+                    tile_hashes[image_id] = tile_hash(image)
+                keys.append(tile_hashes[image_id])
+                tiles.setdefault(keys[-1], msg)
+        vision = self._encode_tiles(tiles)
+        if self.vision_cache is not None:
+            # the other rows of a tile reuse its embeddings
+            self.vision_cache.hits += len(keys) - len(tiles)
+        texts = []
+        merge_length = self.processor.image_processor.merge_size ** 2
+        with span("qwen/preprocess"):
+            for msg, key in zip(messages, keys):
+                text = self.processor.apply_chat_template(msg, tokenize=False, add_generation_prompt=True)
+                # the processor expands the image token to one token per merged patch
+                num_tokens = int(vision[key][0].prod()) // merge_length
+                texts.append(text.replace(self.processor.image_token, self.processor.image_token * num_tokens, 1))
+            inputs = self.processor(text=texts, padding=True, return_tensors="pt")
+            inputs["image_grid_thw"] = torch.stack([vision[key][0] for key in keys])
+        return inputs.to(self.device), torch.cat([vision[key][1] for key in keys])
+
+    def _forward(self, inputs, image_embeds, **kwargs):
+        """Forward pass of the model with the tile embeddings scattered into its image tokens, keeping the logits of the last position only."""
+        inputs_embeds = self.model.get_input_embeddings()(inputs["input_ids"])
+        image_mask = (inputs["input_ids"] == self.model.config.image_token_id).unsqueeze(-1).expand_as(inputs_embeds)
+        inputs_embeds = inputs_embeds.masked_scatter(image_mask, image_embeds.to(inputs_embeds.device, inputs_embeds.dtype))
+        # the input ids are still given, for the positions of the image tokens
+        if self.supports_logits_to_keep:
+            return self.model(**inputs, inputs_embeds=inputs_embeds, logits_to_keep=1, **kwargs)
+        # the pinned Qwen2.5-VL forward takes no logits_to_keep, so feed the head the last position only
+        hook = self.model.lm_head.register_forward_pre_hook(lambda module, args: (args[0][:, -1:, :],))
+        try:
+            return self.model(**inputs, inputs_embeds=inputs_embeds, **kwargs)
+        finally:
+            hook.remove()
+
+    def batch_inference(self, messages, max_new_tokens=128, stop_policies=(), max_chars=None, normalize=None, drafts=None, check_drafts=False):
+        """
+        Generate an answer to each message. With `stop_policies` (see OCRStoppingCriteria), each answer may
+        stop before EOS or max_new_tokens; `max_chars` gives the length limit of each answer, measured
+        after `normalize`.
+
+        With `drafts`, the expected answer of each message (e.g. the ground truth of an OCR answer), answers
+        are generated one at a time by greedy decoding that verifies drafts looked up in them
+        (DraftLookupCandidateGenerator, see _draft_generate). With `check_drafts`, each answer is also
+        generated with plain decoding and the answers that differ are counted in ocr_stats.
+        """
+        max_chars = max_chars or [None] * len(messages)
+        if drafts is not None:
+            return [
+                self._draft_inference(message, draft, max_new_tokens, stop_policies, limit, normalize, check_drafts)
+                for message, draft, limit in zip(messages, drafts, max_chars)
             ]
-            output_texts = self.processor.batch_decode(
-                generated_ids_trimmed,
-                skip_special_tokens=True,
-                clean_up_tokenization_spaces=False,
-            )
+        return self._generate(*self._prepare_inputs(messages), max_new_tokens, stop_policies, max_chars, normalize)
+
+    def _draft_inference(self, message, draft, max_new_tokens, stop_policies, max_chars, normalize, check_drafts):
+        inputs, image_embeds = self._prepare_inputs([message])
+        prompt_length = inputs.input_ids.shape[1]
+        generator = DraftLookupCandidateGenerator(self.processor.tokenizer.encode(draft, add_special_tokens=False), prompt_length, prompt_length + max_new_tokens)
+        answer = self._draft_generate(inputs, image_embeds, generator, max_new_tokens, stop_policies, max_chars, normalize)
+        self.ocr_stats.update({"drafted answers": 1, "draft forward passes": generator.steps, "accepted draft tokens": generator.accepted})
+
+        if check_drafts:
+            self.ocr_stats["checked answers"] += 1
+            if self._generate(inputs, image_embeds, max_new_tokens, stop_policies, [max_chars], normalize, record_stops=False)[0] != answer:
+                self.ocr_stats["answers differing from plain decoding"] += 1
+        return answer
+
+    def _eos_token_ids(self):
+        eos_token_id = self.model.generation_config.eos_token_id
+        return eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+
+    def _stopping_criteria(self, inputs, stop_policies, max_chars, normalize):
+        finished_token_ids = [self.model.generation_config.pad_token_id, *self._eos_token_ids()]
+        return OCRStoppingCriteria(self.processor.tokenizer, inputs.input_ids.shape[1], stop_policies, max_chars, finished_token_ids, normalize)
+
+    def _prefill(self, inputs, image_embeds):
+        """Run the prompt but its last token with the tile embeddings, and return its cache for decoding to continue from."""
+        cache = DynamicCache()
+        prefix = {"input_ids": inputs.input_ids[:, :-1], "attention_mask": inputs.attention_mask[:, :-1], "image_grid_thw": inputs.image_grid_thw}
+        self._forward(prefix, image_embeds, past_key_values=cache, use_cache=True)
+        return cache
+
+    def _generate(self, inputs, image_embeds, max_new_tokens, stop_policies, max_chars, normalize=None, record_stops=True, **generate_kwargs):
+        if stop_policies:
+            criteria = self._stopping_criteria(inputs, stop_policies, max_chars, normalize)
+            generate_kwargs["stopping_criteria"] = StoppingCriteriaList([criteria])
+
+        with torch.no_grad():
+            with span("qwen/generate"):
+                # generate() continues from the cache of the prompt, which it cannot run with the tile embeddings itself
+                cache = self._prefill(inputs, image_embeds)
+                generated_ids = self.model.generate(
+                    input_ids=inputs.input_ids,
+                    attention_mask=inputs.attention_mask,
+                    past_key_values=cache,
+                    max_new_tokens=max_new_tokens,
+                    **generate_kwargs,
+                )
+            if stop_policies and record_stops:
+                self.ocr_stats.update(criteria.tokens_saved(max_new_tokens))
+            with span("qwen/decode"):
+                generated_ids_trimmed = [
+                    out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
+                ]
+                output_texts = self.processor.batch_decode(
+                    generated_ids_trimmed,
+                    skip_special_tokens=True,
+                    clean_up_tokenization_spaces=False,
+                )
         return output_texts
 
+    def _draft_generate(self, inputs, image_embeds, generator, max_new_tokens, stop_policies, max_chars, normalize):
+        """
+        Greedy decoding of a single message that verifies each draft of `generator` in one forward pass.
+
+        The greedy token is computed after every draft token and the answer keeps the model's own token from
+        the first disagreement on, so it is the one of plain greedy decoding. EOS and the stopping criteria see
+        the accepted tokens one at a time, as in plain decoding, and the rejected draft tokens are cropped
+        from the cache.
+        """
+        generation_config = self.model.generation_config
+        if generation_config.do_sample and generation_config.top_k != 1:
+            raise ValueError("Decoding with drafts needs greedy generation (do_sample=False or top_k=1).")
+        processors = LogitsProcessorList()
+        if generation_config.repetition_penalty not in (None, 1.0):
+            processors.append(RepetitionPenaltyLogitsProcessor(generation_config.repetition_penalty))
+        criteria = self._stopping_criteria(inputs, stop_policies, [max_chars], normalize) if stop_policies else None
+        eos_token_ids = set(self._eos_token_ids())
+        prompt_length = inputs.input_ids.shape[1]
+
+        with torch.no_grad():
+            with span("qwen/generate"):
+                cache = self._prefill(inputs, image_embeds)
+                input_ids = inputs.input_ids
+                finished = False
+                while not finished:
+                    candidate_ids, _ = generator.get_candidates(input_ids)
+                    num_drafted = candidate_ids.shape[1] - input_ids.shape[1]
+                    cache_length = cache.get_seq_length()
+                    # the last accepted token and the draft, after the cache; their positions continue from the prompt's rope deltas
+                    logits = self.model(
+                        input_ids=candidate_ids[:, cache_length:],
+                        attention_mask=torch.ones_like(candidate_ids),
+                        past_key_values=cache,
+                        cache_position=torch.arange(cache_length, candidate_ids.shape[1], device=candidate_ids.device),
+                        use_cache=True,
+                    ).logits.float()
+                    tokens = [
+                        int(processors(candidate_ids[:, :input_ids.shape[1] + position], logits[:, position]).argmax(-1))
+                        for position in range(num_drafted + 1)
+                    ]
+                    drafted = candidate_ids[0, input_ids.shape[1]:].tolist()
+                    num_matches = 0
+                    while num_matches < num_drafted and drafted[num_matches] == tokens[num_matches]:
+                        num_matches += 1
+                    generator.update_candidate_strategy(input_ids, None, num_matches)
+
+                    for token in tokens[:num_matches + 1]:
+                        input_ids = torch.cat((input_ids, input_ids.new_tensor([[token]])), dim=1)
+                        finished = (
+                            token in eos_token_ids
+                            or (criteria is not None and bool(criteria(input_ids, None)[0]))
+                            or input_ids.shape[1] - prompt_length >= max_new_tokens
+                        )
+                        if finished:
+                            break
+                    # the cache covers the accepted tokens but the last one, which the next pass runs
+                    cache.crop(input_ids.shape[1] - 1)
+            if criteria is not None:
+                self.ocr_stats.update(criteria.tokens_saved(max_new_tokens))
+            with span("qwen/decode"):
+                return self.processor.decode(input_ids[0, prompt_length:], skip_special_tokens=True, clean_up_tokenization_spaces=False)
+
+    def batch_yes_probability(self, messages):
+        """
+        Run a single forward pass and compare the next-token logits of the Yes and No answers.
+
+        Returns:
+            P(Yes) renormalized over the Yes/No answer tokens, one float per message
+        """
+        inputs, image_embeds = self._prepare_inputs(messages)
+
+        with span("qwen/forward"):
+            with torch.no_grad():
+                logits = self._forward(inputs, image_embeds, use_cache=False).logits[:, -1, :].float()
+
+            yes_logit = torch.logsumexp(logits[:, self.yes_token_ids], dim=-1)
+            no_logit = torch.logsumexp(logits[:, self.no_token_ids], dim=-1)
+            # .cpu() waits for the GPU, so the span covers the whole forward pass
+            return torch.sigmoid(yes_logit - no_logit).cpu().tolist()
+
+    def _semantic_message(self, image_path, question: str):
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image", "image": image_path},
+                    {"type": "text", "text": f"{question}. Please answer 'Yes' or 'No' only."}
+                ],
+            }
+        ]
+
     def infer_semantic(self, images_path: list, question: str):
-        messages = []
-        for image_path in images_path:
-            messages.append([
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "image", "image": image_path},
-                        {"type": "text", "text": f"{question}. Please answer 'Yes' or 'No' only."}
-                    ],
-                }
-            ])
-        return self.batch_inference(messages)
+        messages = [self._semantic_message(image_path, question) for image_path in images_path]
+        return self._with_answer_cache(messages, {"mode": "generate", "max_new_tokens": 128}, self.batch_inference)
+
+    def infer_semantic_logits(self, images_path: list, question: str):
+        """
+        Logit-based counterpart of `infer_semantic` that skips decoding.
+
+        Returns:
+            One (answer, p_yes) tuple per image, where answer is "Yes" if p_yes >= 0.5 else "No"
+        """
+        messages = [self._semantic_message(image_path, question) for image_path in images_path]
+        probs = self._with_answer_cache(messages, {"mode": "logits"}, self.batch_yes_probability)
+        return [("Yes" if p_yes >= 0.5 else "No", p_yes) for p_yes in probs]
+
+    def infer_semantic_pairs(self, images_path: list, questions: list, batch_size: int = 32, use_logits: bool = False):
+        """
+        Answer a flat list of (image, question) pairs in chunks of `batch_size`.
 
-    def infer_ocr(self, images_path: list, max_new_tokens: int = 128):
+        The i-th answer belongs to images_path[i] and questions[i], so callers can
+        flatten every question and tile of one or more prompts into a single call.
+        With `use_logits`, each answer is an (answer, p_yes) tuple as in `infer_semantic_logits`.
+        """
+        assert len(images_path) == len(questions), "Every image needs exactly one question."
+        messages = [self._semantic_message(image_path, question) for image_path, question in zip(images_path, questions)]
+        run_batch = self.batch_yes_probability if use_logits else self.batch_inference
+
+        def compute(messages):
+            outputs = []
+            for start in range(0, len(messages), batch_size):
+                outputs.extend(run_batch(messages[start:start + batch_size]))
+            return outputs
+
+        # cached answers are looked up first so that the remaining misses still form full batches
+        settings = {"mode": "logits"} if use_logits else {"mode": "generate", "max_new_tokens": 128}
+        outputs = self._with_answer_cache(messages, settings, compute)
+        if use_logits:
+            return [("Yes" if p_yes >= 0.5 else "No", p_yes) for p_yes in outputs]
+        return outputs
+
+    def count_tokens(self, texts: list):
+        """Number of tokens of each text, without special tokens."""
+        return [len(ids) for ids in self.processor.tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+    def ocr_report(self):
+        report = dict(self.ocr_stats)
+        if self.ocr_stats["draft forward passes"]:
+            # each forward pass generates one token besides the draft tokens it accepts
+            report["tokens per forward pass"] = round(1 + self.ocr_stats["accepted draft tokens"] / self.ocr_stats["draft forward passes"], 2)
+        return report
+
+    def infer_ocr(self, images_path: list, max_new_tokens: int = 128, stop_policies: tuple = (), max_chars: list = None,
+                  normalize=None, drafts: list = None, check_drafts: bool = False):
+        """
+        Read the text of each image. `stop_policies` (see OCRStoppingCriteria) stop answers early, losing the
+        text they would still have generated, and `max_chars` is the length, in characters of the answer
+        normalized by `normalize` (a module-level function, so that it reaches the model server), past which
+        the 'length' policy stops each answer.
+        `drafts`, the expected text of each image, speed up greedy decoding without changing the answers (see batch_inference).
+        """
         messages = []
         for image_path in images_path:
             messages.append([
@@ -91,9 +460,57 @@ class Qwen2_5VLBatchInferencer:
                     ],
                 }
             ])
-        return self.batch_inference(messages, max_new_tokens=max_new_tokens)
+        settings = {"mode": "generate", "max_new_tokens": max_new_tokens}
+        options = {}
+        if stop_policies:
+            # stopped answers differ from complete ones, so the policies and the limit of each answer are part of its cache key
+            options.update(stop_policies=sorted(stop_policies), max_chars=max_chars or [None] * len(messages), normalize=normalize)
+            normalizer = f"{normalize.__module__}.{normalize.__qualname__}" if normalize is not None else None
+            settings = [{**settings, "stop_policies": options["stop_policies"], "max_chars": limit, "normalize": normalizer} for limit in options["max_chars"]]
+        if drafts is not None:
+            # drafted answers come from other forward passes than plain decoding, so they are cached apart
+            options.update(drafts=drafts, check_drafts=check_drafts)
+            settings = [{**entry, "draft": True} for entry in settings] if isinstance(settings, list) else {**settings, "draft": True}
+        per_message = {key: dict(zip(map(id, messages), options[key])) for key in PER_ITEM_KWARGS & options.keys()}
+
+        def compute(missing):
+            # the options given per message follow the messages missing from the answer cache
+            missing_options = {**options, **{key: [values[id(msg)] for msg in missing] for key, values in per_message.items()}}
+            return self.batch_inference(missing, max_new_tokens=max_new_tokens, **missing_options)
+
+        return self._with_answer_cache(messages, settings, compute)
     
 
+class RemoteQwen2_5VLInferencer(Qwen2_5VLBatchInferencer):
+    """
+    Qwen2_5VLBatchInferencer whose batches run in the warm model server (scripts/utils/model_server.py).
+
+    Messages, batching and the answer cache stay in this process; only `batch_inference` and
+    `batch_yes_probability` are sent to the server, which may merge them with other clients' batches.
+    """
+    def __init__(self, client, model_path: str = "Qwen/Qwen2.5-VL-7B-Instruct", answer_cache=None):
+        # the server keeps its own vision embedding cache and OCR statistics
+        self._init_state(model_path, answer_cache)
+        self.client = client
+        self.tokenizer = None
+
+    def count_tokens(self, texts: list):
+        # tokenizing locally is cheaper than a round trip to the server, which may be busy generating
+        if self.tokenizer is None:
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+        return [len(ids) for ids in self.tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+    def batch_inference(self, messages, max_new_tokens=128, **options):
+        return self.client.call("qwen2.5-vl", {"model_path": self.model_path}, "batch_inference", messages, max_new_tokens=max_new_tokens, **options)
+
+    def ocr_report(self):
+        # counted by the server, over the answers of all of its clients
+        return self.client.call("qwen2.5-vl", {"model_path": self.model_path}, "ocr_report")
+
+    def batch_yes_probability(self, messages):
+        return self.client.call("qwen2.5-vl", {"model_path": self.model_path}, "batch_yes_probability", messages)
+
+
 class CSDStyleEmbedding:
     def __init__(self, model_path: str = "scripts/style/models/checkpoint.pth", device: str = "cuda"):
         self.device = torch.device(device)
@@ -118,8 +535,9 @@ class CSDStyleEmbedding:
         model.load_state_dict(state_dict, strict=False)
         return model
 
-    def get_style_embedding(self, image_path: str):
-        image = Image.open(image_path).convert('RGB')
+    @profiled("style/csd")
+    def get_style_embedding(self, image_path):
+        image = open_image(image_path).convert('RGB')
         image_tensor = self.preprocess(image).unsqueeze(0).to(self.device)
         with torch.no_grad():
             _, _, style_output = self.model(image_tensor)
@@ -138,8 +556,9 @@ class SEStyleEmbedding:
     def _l2_normalize(self, x):
         return torch.nn.functional.normalize(x, p=2, dim=-1)
 
-    def get_style_embedding(self, image_path: str):
-        image = Image.open(image_path).convert('RGB')
+    @profiled("style/se")
+    def get_style_embedding(self, image_path):
+        image = open_image(image_path).convert('RGB')
         inputs = self.processor(images=image, return_tensors="pt").pixel_values.to(self.device, dtype=self.dtype)
 
         with torch.no_grad():
@@ -149,6 +568,18 @@ class SEStyleEmbedding:
         return image_embeds_norm
 
 
+class DreamSimDistance:
+    def __init__(self, device: str = "cuda"):
+        from dreamsim import dreamsim
+        self.device = device
+        self.model, self.preprocess = dreamsim(pretrained=True, device=device)
+
+    def distance(self, image_1_path, image_2_path):
+        image_1 = self.preprocess(open_image(image_1_path)).to(self.device)
+        image_2 = self.preprocess(open_image(image_2_path)).to(self.device)
+        return self.model(image_1, image_2).item()
+
+
 class LLM2CLIP:
     def __init__(self, processor_model="openai/clip-vit-large-patch14-336", 
                  model_name="microsoft/LLM2CLIP-Openai-L-14-336", 
@@ -180,10 +611,11 @@ class LLM2CLIP:
 
         self.device = device
 
+    @profiled("reasoning/llm2clip")
     def text_img_similarity_score(self, image_path_list, text_prompt):
         try:
             captions = [text_prompt]
-            images = [Image.open(image_path) for image_path in image_path_list]
+            images = [open_image(image_path) for image_path in image_path_list]
             
             # Process images and encode text
             input_pixels = self.processor(images=images, return_tensors="pt").pixel_values.to(self.device)
@@ -0,0 +1,296 @@
+import os
+import time
+import pickle
+import socket
+import struct
+import argparse
+import functools
+import threading
+import traceback
+from collections import Counter, deque
+from concurrent.futures import Future
+from typing import NamedTuple
+
+DEFAULT_SOCKET = "cache/model_server.sock"
+# methods taking a list of items first and returning one result per item, whose calls can be merged
+BATCHED_METHODS = {"batch_inference", "batch_yes_probability"}
+# keyword arguments of the batched methods holding one value per item, concatenated when calls are merged
+PER_ITEM_KWARGS = {"max_chars", "drafts"}
+
+
+def server_path():
+    """Socket of the model server: $ONEIG_MODEL_SERVER, or cache/model_server.sock; 'off' disables the server."""
+    return os.environ.get("ONEIG_MODEL_SERVER", DEFAULT_SOCKET)
+
+
+def _send(sock, obj):
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(struct.pack("!Q", len(data)))
+    sock.sendall(data)
+
+
+def _recv_exactly(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if count == 0:
+            return None
+        received += count
+    return buffer
+
+
+def _recv(sock):
+    """Next message, or None once the peer closed the connection."""
+    header = _recv_exactly(sock, 8)
+    if header is None:
+        return None
+    data = _recv_exactly(sock, struct.unpack("!Q", header)[0])
+    return None if data is None else pickle.loads(data)
+
+
+class ModelServerClient:
+    """Connection of a scorer process to the model server; calls are serialized over one socket."""
+    def __init__(self, sock, path):
+        self.sock = sock
+        self.path = path
+        self.lock = threading.Lock()
+
+    def request(self, *message):
+        with self.lock:
+            _send(self.sock, message)
+            response = _recv(self.sock)
+        if response is None:
+            raise ConnectionError(f"The model server at {self.path} closed the connection.")
+        status, result = response
+        if status == "error":
+            raise RuntimeError(f"The model server at {self.path} failed:\n{result}")
+        return result
+
+    def call(self, name, loader_kwargs, method, *args, **kwargs):
+        """Run `method` of backbone `name` (loaded with `loader_kwargs`) in the server and return its result."""
+        return self.request("call", name, loader_kwargs, method, args, kwargs)
+
+
+_client = None
+
+
+def connect():
+    """Client of the model server listening on server_path(), or None when no server is running."""
+    global _client
+    if _client is None:
+        path = server_path()
+        if path == "off" or not os.path.exists(path):
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except OSError:
+            # a socket file left behind by a server that is gone
+            sock.close()
+            return None
+        _client = ModelServerClient(sock, path)
+        print(f"Using the warm models of the model server at {path}")
+    return _client
+
+
+class RemoteModel:
+    """Proxy of a backbone held by the model server: `proxy.method(...)` runs `model.method(...)` in the server."""
+    def __init__(self, client, name, loader_kwargs):
+        self.client = client
+        self.name = name
+        self.loader_kwargs = loader_kwargs
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+        return functools.partial(self.client.call, self.name, self.loader_kwargs, method)
+
+
+class _Call(NamedTuple):
+    name: str
+    loader_kwargs: dict
+    method: str
+    args: tuple
+    kwargs: dict
+    future: Future
+
+    @property
+    def batch_key(self):
+        settings = tuple(sorted((key, value) for key, value in self.kwargs.items() if key not in PER_ITEM_KWARGS))
+        return (self.name, tuple(sorted(self.loader_kwargs.items())), self.method, settings)
+
+    def item_kwargs(self, key):
+        return self.kwargs.get(key) or [None] * len(self.args[0])
+
+
+class ModelServer:
+    """
+    Long-lived process holding the loaded backbones and serving their methods over a Unix socket.
+
+    Calls from every connected scorer are run one at a time by a single worker thread, since they share
+    the GPU. A `batch_inference` or `batch_yes_probability` call waits up to `batch_window` seconds for
+    compatible calls of other clients (same model, method and settings), and they are run as one batch of
+    at most `max_batch` messages. Messages are pickled, so the socket is only accessible to its owner.
+    """
+    def __init__(self, path: str, batch_window: float = 0.005, max_batch: int = 64):
+        self.path = path
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.calls = Counter()
+        self.merged_calls = 0
+        self.num_clients = 0
+        self.listener = None
+        self.stopping = False
+
+    def serve_forever(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.listener.listen()
+        threading.Thread(target=self._work, daemon=True).start()
+        print(f"Model server listening on {self.path}")
+
+        try:
+            while not self.stopping:
+                try:
+                    conn, _ = self.listener.accept()
+                except OSError:
+                    break
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            self.listener.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            print("Model server stopped")
+
+    def preload(self, names):
+        from scripts.utils.models import load_local_model
+        for name in names:
+            start = time.perf_counter()
+            load_local_model(name)
+            print(f"Loaded {name} in {time.perf_counter() - start:.1f}s")
+
+    def status(self):
+        from scripts.utils.models import _instances
+        return {
+            "models": [f"{name}({', '.join(f'{key}={value!r}' for key, value in arguments)})" for name, arguments in _instances],
+            "clients": self.num_clients,
+            "calls": dict(self.calls),
+            "merged_calls": self.merged_calls,
+        }
+
+    def _handle(self, conn):
+        self.num_clients += 1
+        try:
+            while True:
+                message = _recv(conn)
+                if message is None:
+                    break
+                if message[0] == "call":
+                    future = Future()
+                    with self.cond:
+                        self.queue.append(_Call(*message[1:], future))
+                        self.cond.notify()
+                    _send(conn, future.result())
+                elif message[0] == "status":
+                    _send(conn, ("ok", self.status()))
+                elif message[0] == "stop":
+                    _send(conn, ("ok", None))
+                    self.stopping = True
+                    # unblock accept() in serve_forever
+                    self.listener.shutdown(socket.SHUT_RDWR)
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.num_clients -= 1
+            conn.close()
+
+    def _next_batch(self):
+        with self.cond:
+            while not self.queue:
+                self.cond.wait()
+            first = self.queue.popleft()
+            batch = [first]
+            if first.method not in BATCHED_METHODS:
+                return batch
+
+            size = len(first.args[0])
+            deadline = time.monotonic() + self.batch_window
+            while size < self.max_batch:
+                for call in list(self.queue):
+                    if call.batch_key == first.batch_key and size + len(call.args[0]) <= self.max_batch:
+                        self.queue.remove(call)
+                        batch.append(call)
+                        size += len(call.args[0])
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return batch
+
+    def _work(self):
+        from scripts.utils.models import load_local_model
+        while True:
+            batch = self._next_batch()
+            first = batch[0]
+            try:
+                method = getattr(load_local_model(first.name, **first.loader_kwargs), first.method)
+                if len(batch) == 1:
+                    results = [method(*first.args, **first.kwargs)]
+                else:
+                    kwargs = dict(first.kwargs)
+                    for key in PER_ITEM_KWARGS & kwargs.keys():
+                        kwargs[key] = [value for call in batch for value in call.item_kwargs(key)]
+                    outputs = method([item for call in batch for item in call.args[0]], **kwargs)
+                    results, start = [], 0
+                    for call in batch:
+                        results.append(outputs[start:start + len(call.args[0])])
+                        start += len(call.args[0])
+                    self.merged_calls += len(batch)
+                self.calls[f"{first.name}.{first.method}"] += len(batch)
+                for call, result in zip(batch, results):
+                    call.future.set_result(("ok", result))
+            except Exception:
+                error = traceback.format_exc()
+                for call in batch:
+                    call.future.set_result(("error", error))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep the evaluation models loaded and serve them to the scorers over a Unix socket.")
+    parser.add_argument("command", choices=["serve", "status", "stop"], help="Start a server, or query or stop the running one.")
+    parser.add_argument("--socket", type=str, default=server_path(), help="Path of the Unix socket (the scorers use $ONEIG_MODEL_SERVER, default cache/model_server.sock).")
+    parser.add_argument("--preload", type=str, nargs="*", default=[], help="Backbones loaded at startup (qwen2.5-vl, csd, style_encoder, llm2clip, dreamsim); others are loaded on first use.")
+    parser.add_argument("--batch_window", type=float, default=0.005, help="Seconds a VLM batch waits for compatible batches of other scorers to be merged with.")
+    parser.add_argument("--max_batch", type=int, default=64, help="Maximum number of messages in a merged VLM batch.")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        server = ModelServer(args.socket, args.batch_window, args.max_batch)
+        server.preload(args.preload)
+        server.serve_forever()
+        return
+
+    os.environ["ONEIG_MODEL_SERVER"] = args.socket
+    client = connect()
+    if client is None:
+        print(f"No model server is running at {args.socket}")
+        return
+    if args.command == "status":
+        for name, value in client.request("status").items():
+            print(f"{name}: {value}")
+    else:
+        client.request("stop")
+        print(f"Stopped the model server at {args.socket}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Lazy registry of the model backbones used by the scorers.
+
+Scorer modules only import this registry, so `--help`, argument errors, `scripts.merge` and dry runs
+never import torch or transformers. `load_model` returns a handle, and the backbone is imported and
+its weights loaded the first time the handle is used, so scorers can also be created to plan a run
+(--plan) without loading anything. Handles with the same arguments share one instance (e.g.
+Qwen2.5-VL for alignment and text in one process). When a warm model server is running
+(scripts/utils/model_server.py) when a handle is first used, it forwards to the server's copy instead.
+"""
+import inspect
+from scripts.utils.model_server import RemoteModel, connect
+
+_factories = {}
+_remote_factories = {}
+_instances = {}
+
+
+def register(name, remote=None):
+    """
+    Decorator registering `factory(**kwargs)` as the loader of backbone `name`, and `remote(client, **kwargs)`
+    as the proxy used when the model server is running. A later registration replaces both, e.g. the
+    stand-in models of scripts.benchmark, which are never served.
+    """
+    def decorator(factory):
+        _factories[name] = factory
+        _remote_factories.pop(name, None)
+        if remote is not None:
+            _remote_factories[name] = remote
+        for key in [key for key in _instances if key[0] == name]:
+            del _instances[key]
+        return factory
+    return decorator
+
+
+def load_local_model(name, **kwargs):
+    """Load backbone `name` in this process, once per distinct arguments (defaults included)."""
+    arguments = inspect.signature(_factories[name]).bind(**kwargs)
+    arguments.apply_defaults()
+    key = (name, tuple(sorted(arguments.arguments.items())))
+    if key not in _instances:
+        _instances[key] = _factories[name](**kwargs)
+    return _instances[key]
+
+
+def _resolve(name, **kwargs):
+    if name in _remote_factories:
+        client = connect()
+        if client is not None:
+            return _remote_factories[name](client, **kwargs)
+    return load_local_model(name, **kwargs)
+
+
+class LazyModel:
+    """Handle returned by load_model, forwarding attribute access to the backbone once it is loaded."""
+    def __init__(self, name, kwargs):
+        self._name = name
+        self._kwargs = kwargs
+        self._model = None
+
+    def __getattr__(self, attr):
+        if self._model is None:
+            self._model = _resolve(self._name, **self._kwargs)
+        return getattr(self._model, attr)
+
+
+def load_model(name, **kwargs):
+    return LazyModel(name, kwargs)
+
+
+def _served(name):
+    return lambda client, **kwargs: RemoteModel(client, name, kwargs)
+
+
+def _remote_qwen(client, model_path="Qwen/Qwen2.5-VL-7B-Instruct", answer_cache=None):
+    from scripts.utils.inference import RemoteQwen2_5VLInferencer
+    return RemoteQwen2_5VLInferencer(client, model_path, answer_cache=answer_cache)
+
+
+@register("qwen2.5-vl", remote=_remote_qwen)
+def _load_qwen(model_path="Qwen/Qwen2.5-VL-7B-Instruct", answer_cache=None):
+    from scripts.utils.inference import Qwen2_5VLBatchInferencer
+    return Qwen2_5VLBatchInferencer(model_path, answer_cache=answer_cache)
+
+
+@register("csd", remote=_served("csd"))
+def _load_csd(model_path="scripts/style/models/checkpoint.pth"):
+    from scripts.utils.inference import CSDStyleEmbedding
+    return CSDStyleEmbedding(model_path=model_path)
+
+
+@register("style_encoder", remote=_served("style_encoder"))
+def _load_style_encoder(pretrained_path="xingpng/OneIG-StyleEncoder"):
+    from scripts.utils.inference import SEStyleEmbedding
+    return SEStyleEmbedding(pretrained_path=pretrained_path)
+
+
+@register("llm2clip", remote=_served("llm2clip"))
+def _load_llm2clip():
+    from scripts.utils.inference import LLM2CLIP
+    return LLM2CLIP()
+
+
+@register("dreamsim", remote=_served("dreamsim"))
+def _load_dreamsim(device="cuda"):
+    from scripts.utils.inference import DreamSimDistance
+    return DreamSimDistance(device=device)
@@ -0,0 +1,430 @@
+import os
+import json
+import time
+import zlib
+import shutil
+import traceback
+import pandas as pd
+from typing import NamedTuple
+from collections import Counter
+from tqdm import tqdm
+try:
+    import fcntl
+except ImportError:
+    # no record log locking on Windows
+    fcntl = None
+
+from scripts.utils.utils import split_2x2_grid, get_image_path, get_eval_targets, make_grid_cache_dir, load_tile_manifest, on_rm_error, save2csv
+from scripts.utils.image_manifest import ImageManifest
+from scripts.utils.work_queue import WorkQueue
+from scripts.utils.prefetch import PrefetchLoader
+from scripts.utils import profiler
+from scripts.utils.profiler import span, profiled
+
+import datetime
+current_time = datetime.datetime.now()
+formatted_time = current_time.strftime("%Y-%m-%d_%H-%M-%S")
+
+
+class GridTask(NamedTuple):
+    """One prompt of one category for one evaluated target; image_paths holds every file matching the prompt id."""
+    category: str
+    key: str
+    target_id: int
+    image_paths: list
+
+
+@profiled("listing")
+def list_grids(args, target, category, image_manifest):
+    """Return {prompt id: [image paths]} for one category directory of a target."""
+    _, model_name, checkpoint, _ = target
+    # New path structure: base/model/image_type/checkpoint/language/category/
+    image_dir = get_image_path(args.image_dirname, model_name, args.image_type, checkpoint, args.mode, category)
+    return image_manifest.list(image_dir)
+
+
+def shard_of(category, key, num_shards):
+    """Deterministic shard of a prompt, identical on every worker and across runs."""
+    return zlib.crc32(f"{category}/{key}".encode("utf-8")) % num_shards
+
+
+def sort_records(records, categories):
+    """Order per-prompt records by category, prompt id and image, so results do not depend on the processing order."""
+    return sorted(records, key=lambda record: (categories.index(record["category"]), record["key"], record.get("path", "")))
+
+
+def run_fingerprint(args):
+    """Settings that determine the per-prompt records of a run, so that records of other settings are never mixed in."""
+    return {
+        "mode": args.mode,
+        "image_dirname": args.image_dirname,
+        "image_type": args.image_type,
+        "targets": [[label, model_name, checkpoint, list(img_grid)] for label, model_name, checkpoint, img_grid in get_eval_targets(args)],
+        "scoring": args.scoring,
+        "ask_all_questions": args.ask_all_questions,
+        "skip_tiles": sorted(args.skip_tiles),
+        "ocr_stopping": sorted(args.ocr_stopping),
+    }
+
+
+def get_records_path(args, name, shard_id=None):
+    shard_id = args.shard_id if shard_id is None else shard_id
+    fingerprint = zlib.crc32(json.dumps(run_fingerprint(args), sort_keys=True).encode("utf-8"))
+    return os.path.join(args.records_dir, f"{name}_{args.mode}_{fingerprint:08x}_shard{shard_id}of{args.num_shards}.jsonl")
+
+
+def read_records(records_path):
+    """(header line, empty without one, and the records) of a record log."""
+    header, records = {}, []
+    with open(records_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # a line cut short by a crash
+                continue
+            if "run_fingerprint" in record:
+                header = record
+            else:
+                records.append(record)
+    return header, records
+
+
+def load_records(records_path):
+    return read_records(records_path)[1]
+
+
+def prompt_score_frame(rows, labels):
+    """Build the per-prompt score table from {row: {label: score}} in one go instead of growing it row by row."""
+    return pd.DataFrame.from_dict(rows, orient="index", columns=labels, dtype=object)
+
+
+class RecordLog:
+    """
+    Append-only JSONL log of the per-prompt records of one scorer, flushed to disk as they are produced.
+
+    The log starts with a header holding the run fingerprint (see run_fingerprint) and the categories of
+    the scorer, in the order its results are written, so that scripts.merge needs neither. With `resume`, the
+    records already in the log are kept and `done` holds their (category, prompt id, model label), so that
+    an interrupted run only scores what is missing; a log written with other settings is refused. Otherwise
+    the log starts empty. The log is locked while it is open, so a second run with the same settings fails
+    instead of interleaving its records.
+    """
+    def __init__(self, path: str, resume: bool = False, fingerprint: dict = None, categories: list = None):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "a+", encoding="utf-8")
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.file.close()
+                raise RuntimeError(f"{path} is being written by another run with the same settings.")
+
+        self.records = []
+        if resume:
+            header, self.records = read_records(path)
+            if self.records and header.get("run_fingerprint") != fingerprint:
+                self.file.close()
+                raise ValueError(f"{path} was written by a run with other settings ({header.get('run_fingerprint')}); remove it or run without --resume.")
+        self.done = {(record["category"], record["key"], record["label"]) for record in self.records}
+        # rewrite the header and the valid records, which also drops a partial last line
+        self.file.seek(0)
+        self.file.truncate()
+        for record in [{"run_fingerprint": fingerprint, "categories": categories}, *self.records]:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    @profiled("write/records")
+    def append(self, records):
+        if not records:
+            return
+        for record in records:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.records.extend(records)
+
+    def close(self):
+        self.file.close()
+
+
+def prompt_cost(scorers, selected_sets, category, key):
+    """Relative cost of scoring a prompt, so that a work queue hands out the most expensive prompts first."""
+    return sum(
+        scorer.cost(category, key) if hasattr(scorer, "cost") else 1
+        for scorer, selected_keys in zip(scorers, selected_sets) if key in selected_keys
+    )
+
+
+def is_fatal(error):
+    """Errors that would fail every prompt on this worker, such as running out of (GPU) memory, unlike a bad prompt."""
+    return isinstance(error, MemoryError) or type(error).__name__ == "OutOfMemoryError"
+
+
+def select_prompts(args, category, category_scorers, listed_keys):
+    """Prompt ids selected by each scorer as sets, and their union in this shard in a stable order."""
+    selected = [scorer.select(category, listed_keys) for scorer in category_scorers]
+    keys = list(dict.fromkeys(key for keys in selected for key in keys))
+    if args.num_shards > 1:
+        keys = [key for key in keys if shard_of(category, key, args.num_shards) == args.shard_id]
+    return [set(keys) for keys in selected], keys
+
+
+def work_units(scorer, task, tile_counts):
+    """Model calls of a grid task for a scorer, as {unit: count}, from its optional `work(task, tile_counts)`."""
+    return scorer.work(task, tile_counts) if hasattr(scorer, "work") else {}
+
+
+def save_throughput(args, throughput):
+    """
+    Append the time spent per unit of work in this run, as {name: (unit, units, seconds, stall seconds)},
+    to --throughput_log. Stall seconds, None for work done in the scoring loop itself, are the part of
+    the time the scoring loop waited for, less than the time of grids fetched ahead by --prefetch.
+    """
+    if not args.throughput_log:
+        return
+    os.makedirs(os.path.dirname(args.throughput_log) or ".", exist_ok=True)
+    with open(args.throughput_log, "a", encoding="utf-8") as f:
+        for name, (unit, units, seconds, stall_seconds) in throughput.items():
+            if units:
+                run = {"name": name, "unit": unit, "units": units, "seconds": seconds, "mode": args.mode, "time": formatted_time}
+                if stall_seconds is not None:
+                    run["stall_seconds"] = stall_seconds
+                f.write(json.dumps(run) + "\n")
+
+
+def estimate_seconds(history, name, unit, units, recent=10, field="seconds"):
+    """Time (`field` of the log) of `units` of work at the throughput of the last `recent` runs, or None without past runs."""
+    runs = [run for run in history if run["name"] == name and run["unit"] == unit and field in run][-recent:]
+    if not runs:
+        return None
+    return units * sum(run[field] for run in runs) / sum(run["units"] for run in runs)
+
+
+def plan_scorers(args, scorers):
+    """
+    Count the grids, valid tiles and model calls that run_scorers would process, without loading any
+    model, and estimate the duration of each metric from the throughput of past runs (--throughput_log).
+
+    Every grid is read and checked for invalid tiles (and recorded in --tile_manifest), so that missing
+    images and grids without a valid tile, which would get a None score, show up before the run.
+    """
+    targets = get_eval_targets(args)
+    image_manifest = ImageManifest(args.image_manifest, args.refresh_image_manifest)
+    tile_manifest = load_tile_manifest(args, image_manifest)
+    history = load_records(args.throughput_log) if args.throughput_log and os.path.exists(args.throughput_log) else []
+    work = {scorer.name: Counter() for scorer in scorers}
+    num_grids = 0
+    missing = []
+
+    categories = list(dict.fromkeys(category for scorer in scorers for category in scorer.categories))
+    for category in categories:
+        listings = [list_grids(args, target, category, image_manifest) for target in targets]
+        category_scorers = [scorer for scorer in scorers if category in scorer.categories]
+        selected_sets, keys = select_prompts(args, category, category_scorers, sorted(set().union(*listings)))
+        tasks = [GridTask(category, key, target_id, listings[target_id].get(key, [])) for key in keys for target_id in range(len(targets))]
+
+        for task in tasks:
+            if not task.image_paths:
+                missing.append({"category": category, "key": task.key, "label": targets[task.target_id][0]})
+                for scorer, selected_keys in zip(category_scorers, selected_sets):
+                    if task.key in selected_keys:
+                        work[scorer.name]["missing grids"] += 1
+
+        def count_tiles(task):
+            img_grid = targets[task.target_id][3]
+            return [len(split_2x2_grid(img_path, img_grid, None, args.skip_tiles, tile_manifest)) for img_path in task.image_paths]
+
+        loader = PrefetchLoader([task for task in tasks if task.image_paths], count_tiles, args.prefetch, args.prefetch_workers)
+        for task, tile_counts in tqdm(loader, total=len(loader), desc=f"Planning {category}"):
+            num_grids += len(tile_counts)
+            for scorer, selected_keys in zip(category_scorers, selected_sets):
+                if task.key not in selected_keys:
+                    continue
+                counts = work[scorer.name]
+                counts["grids"] += len(tile_counts)
+                counts["valid tiles"] += sum(tile_counts)
+                counts["grids without valid tiles"] += sum(tile_count == 0 for tile_count in tile_counts)
+                counts.update(work_units(scorer, task, tile_counts))
+
+    shard = f", shard {args.shard_id}/{args.num_shards}" if args.num_shards > 1 else ""
+    print(f"\nPlan for {len(targets)} targets ({args.mode}{shard}): {num_grids} grids to fetch")
+    load_seconds = estimate_seconds(history, "grids", "grids", num_grids)
+    stall_seconds = estimate_seconds(history, "grids", "grids", num_grids, field="stall_seconds")
+    stalled = f" (~{datetime.timedelta(seconds=round(stall_seconds))} not overlapped with scoring)" if stall_seconds is not None else ""
+    print(f"  {'fetch, decode and split':<32}{'':>12}  ~{datetime.timedelta(seconds=round(load_seconds)) if load_seconds is not None else '?'}{stalled}")
+    # grids fetched ahead by --prefetch only add the time the scorers waited for them
+    total_seconds = stall_seconds if stall_seconds is not None else load_seconds or 0.0
+    for scorer in scorers:
+        counts = work[scorer.name]
+        unit = getattr(scorer, "work_unit", None)
+        seconds = estimate_seconds(history, scorer.name, unit, counts[unit]) if unit else None
+        print(f"{scorer.name}: ~{datetime.timedelta(seconds=round(seconds)) if seconds is not None else '? (no past run to estimate from)'}")
+        for name in ["grids", "valid tiles", "missing grids", "grids without valid tiles"] + [name for name in counts if name not in ("grids", "valid tiles", "missing grids", "grids without valid tiles")]:
+            print(f"  {name:<32}{counts[name]:>12}")
+        total_seconds += seconds or 0.0
+    print(f"Estimated total: ~{datetime.timedelta(seconds=round(total_seconds))} (metrics without past runs are not included)")
+
+    if missing:
+        missing_csv = f"results/plan_missing_{args.mode}_{formatted_time}.csv"
+        os.makedirs(os.path.dirname(missing_csv), exist_ok=True)
+        print(f"\n{len(missing)} grids are missing and would be scored as None, e.g. " + ", ".join(f"{item['label']} {item['category']}/{item['key']}" for item in missing[:10]))
+        save2csv(pd.DataFrame(missing), missing_csv)
+
+
+def run_scorers(args, scorers):
+    """
+    Fetch, decode and split every grid needed by `scorers` exactly once and hand its tiles to each of them.
+
+    A scorer exposes `name`, `categories`, `select(category, listed_keys)` returning the prompt ids it
+    scores in that category, `score(task, target, grids)` called with one (image path, tiles) pair per
+    matching file, `end_category(category)` and `finish()`, and optionally `cost(category, key)` and
+    `work(task, tile_counts)` counting its model calls in `work_unit` units for --plan, and
+    `discard_pending()` dropping grids it batches across prompts when their prompts failed. Its
+    per-prompt `records` are saved under --records_dir and aggregated into the result CSVs by
+    `save_results(args, records, categories)`. With several shards only the records are saved, and scripts.merge
+    aggregates them once every shard is done. With --work_queue, prompts are leased from a queue shared
+    with other workers, and the worker that finishes the last prompt writes the result CSVs. With
+    --profile, the time spent in each stage is printed at the end and saved as a Chrome trace. With
+    --plan, nothing is scored and plan_scorers reports the work of the run instead.
+    """
+    if args.plan:
+        return plan_scorers(args, scorers)
+    if args.profile:
+        profiler.enable()
+    assert 0 <= args.shard_id < args.num_shards, f"--shard_id must be in [0, {args.num_shards})."
+    assert args.work_queue is None or args.num_shards == 1, "--work_queue replaces --num_shards."
+    targets = get_eval_targets(args)
+    image_manifest = ImageManifest(args.image_manifest, args.refresh_image_manifest)
+    tile_manifest = load_tile_manifest(args, image_manifest)
+    work_queue = WorkQueue(args.work_queue, args.queue_lease, args.queue_max_attempts, run_fingerprint(args)) if args.work_queue else None
+    if work_queue is not None:
+        for scorer in scorers:
+            work_queue.save_categories(scorer.name, scorer.categories)
+    # per-prompt records are streamed to --records_dir as they are produced (the work queue stores its own)
+    record_logs = {scorer.name: RecordLog(get_records_path(args, scorer.name), args.resume, run_fingerprint(args), scorer.categories) for scorer in scorers} if work_queue is None else {}
+    num_logged = {scorer.name: 0 for scorer in scorers}
+
+    def log_records(scorers):
+        for scorer in scorers:
+            if scorer.name in record_logs:
+                record_logs[scorer.name].append(scorer.records[num_logged[scorer.name]:])
+                num_logged[scorer.name] = len(scorer.records)
+    # time per unit of work, recorded so that --plan can estimate later runs
+    throughput = {scorer.name: [getattr(scorer, "work_unit", None), 0, 0.0, None] for scorer in scorers}
+    throughput["grids"] = ["grids", 0, 0.0, 0.0]
+    # tiles stay in memory unless --save_tiles asks for the JPEG files in cache_dir
+    tile_cache_dir = f"tmp_{formatted_time}" if args.save_tiles else None
+
+    categories = list(dict.fromkeys(category for scorer in scorers for category in scorer.categories))
+    for category in categories:
+
+        print(f"We process {category} now.")
+
+        listings = [list_grids(args, target, category, image_manifest) for target in targets]
+        listed_keys = sorted(set().union(*listings))
+        print(f"We fetch {sum(len(paths) for listing in listings for paths in listing.values())} images.")
+
+        category_scorers = [scorer for scorer in scorers if category in scorer.categories]
+        selected_sets, keys = select_prompts(args, category, category_scorers, listed_keys)
+
+        def load_grid(task):
+            img_grid = targets[task.target_id][3]
+            # each grid gets its own tile directory so that grids split ahead of time do not overwrite each other
+            return [
+                (img_path, split_2x2_grid(img_path, img_grid, make_grid_cache_dir(tile_cache_dir, os.path.join(category, f"{task.key}_{task.target_id}_{idx}")), args.skip_tiles, tile_manifest))
+                for idx, img_path in enumerate(task.image_paths)
+            ]
+
+        def task_scorers(task):
+            label = targets[task.target_id][0]
+            return [
+                scorer for scorer, selected_keys in zip(category_scorers, selected_sets)
+                if task.key in selected_keys and (scorer.name not in record_logs or (category, task.key, label) not in record_logs[scorer.name].done)
+            ]
+
+        def score_grids(keys):
+            tasks = [GridTask(category, key, target_id, listings[target_id].get(key, [])) for key in keys for target_id in range(len(targets))]
+            # grids already recorded by every scorer (--resume) are not even fetched
+            tasks = [task for task in tasks if task_scorers(task)]
+            loader = PrefetchLoader(tasks, load_grid, args.prefetch, args.prefetch_workers)
+
+            for task, grids in tqdm(loader, total=len(loader), desc=f"Processing {category}"):
+                throughput["grids"][1] += len(grids)
+                for scorer in task_scorers(task):
+                    start = time.perf_counter()
+                    with span(f"score/{scorer.name}"):
+                        scorer.score(task, targets[task.target_id], grids)
+                    throughput[scorer.name][1] += work_units(scorer, task, [len(tiles) for _, tiles in grids]).get(throughput[scorer.name][0], 0)
+                    throughput[scorer.name][2] += time.perf_counter() - start
+                log_records(category_scorers)
+
+            for scorer in category_scorers:
+                start = time.perf_counter()
+                with span(f"score/{scorer.name}"):
+                    scorer.end_category(category)
+                throughput[scorer.name][2] += time.perf_counter() - start
+            log_records(category_scorers)
+            throughput["grids"][2] += loader.load_time
+            throughput["grids"][3] += loader.stall_time
+            loader.report(f"prefetch {category}")
+
+        if work_queue is None:
+            score_grids(keys)
+        else:
+            work_queue.add_tasks(category, {key: prompt_cost(category_scorers, selected_sets, category, key) for key in keys})
+            while True:
+                with span("queue/claim"):
+                    claimed = work_queue.claim(category, max(1, args.prompts_per_batch))
+                if not claimed:
+                    break
+                num_records = [len(scorer.records) for scorer in category_scorers]
+                try:
+                    score_grids(claimed)
+                except Exception as e:
+                    print(f"Work queue {args.work_queue}: scoring {category} prompts {claimed} failed:")
+                    traceback.print_exc()
+                    work_queue.fail(category, claimed, e)
+                    if is_fatal(e):
+                        raise
+                    # the prompts are retried later, by this or another worker, without their partial results
+                    for scorer, start in zip(category_scorers, num_records):
+                        del scorer.records[start:]
+                        if hasattr(scorer, "discard_pending"):
+                            scorer.discard_pending()
+                    continue
+                with span("queue/complete"):
+                    work_queue.complete(category, claimed, {scorer.name: scorer.records[start:] for scorer, start in zip(category_scorers, num_records)})
+
+        if tile_cache_dir is not None and os.path.exists(os.path.join(tile_cache_dir, category)):
+            shutil.rmtree(os.path.join(tile_cache_dir, category), onerror=on_rm_error)
+
+    for scorer in scorers:
+        scorer.finish()
+    save_throughput(args, throughput)
+
+    if work_queue is not None:
+        # the records of every worker are stored in the queue
+        if work_queue.is_drained() and work_queue.claim_finalization():
+            if work_queue.counts()["failed"]:
+                print(f"Work queue {args.work_queue}: {work_queue.counts()['failed']} prompts failed and are missing from the results.")
+            for scorer in scorers:
+                scorer.save_results(args, work_queue.load_records(scorer.name), scorer.categories)
+        else:
+            print(f"Work queue {args.work_queue}: {work_queue.counts()}; the last worker (or scripts.merge --work_queue) writes the results.")
+    else:
+        for scorer in scorers:
+            record_log = record_logs[scorer.name]
+            record_log.close()
+            if args.num_shards > 1:
+                print(f"Saved shard {args.shard_id}/{args.num_shards} of {scorer.name} to {record_log.path}; run scripts.merge once every shard is done.")
+            else:
+                scorer.save_results(args, record_log.records, scorer.categories)
+
+    if tile_cache_dir is not None and os.path.exists(tile_cache_dir):
+        shutil.rmtree(tile_cache_dir, onerror=on_rm_error)
+
+    if args.profile:
+        profiler.report()
+        profiler.save_trace(args.profile_trace or f"results/trace_{args.mode}_{formatted_time}.json")
@@ -0,0 +1,90 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PrefetchLoader:
+    """
+    Run `load_fn` on the upcoming items in background threads while the scoring loop works on the current one.
+
+    Items are yielded in their original order as (item, loaded) pairs. At most `depth` items are
+    loaded ahead of the consumer; with depth 0 everything is loaded inline in the main thread.
+    Exceptions raised by `load_fn` are re-raised when the corresponding item is reached.
+
+    `load_time` adds up the time spent in `load_fn` over all threads, and `stall_time` the part of it
+    the consumer waited for.
+    """
+    def __init__(self, items, load_fn, depth: int = 4, num_workers: int = 2):
+        self.items = list(items)
+        self.load_fn = load_fn
+        self.depth = depth
+        self.num_workers = max(1, num_workers)
+        self.num_items = 0
+        self.stall_time = 0.0
+        self.load_time = 0.0
+        self.ready_ahead = []
+        self.elapsed = 0.0
+
+    def __len__(self):
+        return len(self.items)
+
+    def _timed_load(self, item):
+        start = time.perf_counter()
+        loaded = self.load_fn(item)
+        return loaded, time.perf_counter() - start
+
+    def __iter__(self):
+        start_time = time.perf_counter()
+        try:
+            if self.depth <= 0:
+                for item in self.items:
+                    loaded, seconds = self._timed_load(item)
+                    self.stall_time += seconds
+                    self.load_time += seconds
+                    self.num_items += 1
+                    yield item, loaded
+                return
+
+            with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+                pending = deque()
+                next_idx = 0
+                while next_idx < len(self.items) and len(pending) < self.depth:
+                    pending.append((self.items[next_idx], executor.submit(self._timed_load, self.items[next_idx])))
+                    next_idx += 1
+
+                while pending:
+                    item, future = pending.popleft()
+                    # how many items were already decoded and waiting when the consumer asked for the next one
+                    self.ready_ahead.append(int(future.done()) + sum(other.done() for _, other in pending))
+                    wait_start = time.perf_counter()
+                    loaded, seconds = future.result()
+                    self.stall_time += time.perf_counter() - wait_start
+                    self.load_time += seconds
+
+                    if next_idx < len(self.items):
+                        pending.append((self.items[next_idx], executor.submit(self._timed_load, self.items[next_idx])))
+                        next_idx += 1
+
+                    self.num_items += 1
+                    yield item, loaded
+        finally:
+            self.elapsed += time.perf_counter() - start_time
+
+    def stats(self):
+        return {
+            "items": self.num_items,
+            "depth": self.depth,
+            "avg_ready_ahead": sum(self.ready_ahead) / len(self.ready_ahead) if self.ready_ahead else 0.0,
+            "load_seconds": self.load_time,
+            "stall_seconds": self.stall_time,
+            "stall_fraction": self.stall_time / self.elapsed if self.elapsed else 0.0,
+            "items_per_second": self.num_items / self.elapsed if self.elapsed else 0.0,
+        }
+
+    def report(self, name: str = "prefetch"):
+        stats = self.stats()
+        print(
+            f"[{name}] {stats['items']} items at {stats['items_per_second']:.2f} items/s, "
+            f"queue depth {stats['depth']} (avg {stats['avg_ready_ahead']:.2f} ready ahead), "
+            f"stalled {stats['stall_seconds']:.1f}s ({stats['stall_fraction']:.1%})"
+        )
@@ -0,0 +1,95 @@
+import os
+import json
+import time
+import functools
+import threading
+
+_enabled = False
+_events = []
+_start = None
+
+
+def enable():
+    """Start recording spans, dropping earlier ones; until then span() and profiled() cost a single flag check."""
+    global _enabled, _start
+    _enabled = True
+    _events.clear()
+    _start = time.perf_counter()
+
+
+def is_enabled():
+    return _enabled
+
+
+class span:
+    """
+    Time a stage of the evaluation, as a context manager:
+
+        with span("qwen/generate"):
+            ...
+
+    Spans may nest and may be recorded from several threads (e.g. the prefetch workers).
+    """
+    __slots__ = ("name", "begin")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.begin = None
+
+    def __enter__(self):
+        if _enabled:
+            self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.begin is not None:
+            end = time.perf_counter()
+            _events.append((self.name, self.begin, end - self.begin, threading.get_ident()))
+        return False
+
+
+def profiled(name: str):
+    """Decorator recording every call of a function as a span."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summary():
+    """Per-span {calls, total seconds} in order of total time; spans of parallel threads overlap."""
+    stages = {}
+    for name, _, duration, _ in _events:
+        calls, total = stages.get(name, (0, 0.0))
+        stages[name] = (calls + 1, total + duration)
+    return dict(sorted(stages.items(), key=lambda item: -item[1][1]))
+
+
+def report():
+    if not _enabled:
+        return
+    wall = time.perf_counter() - _start
+    print(f"{'stage':<28}{'calls':>10}{'total (s)':>12}{'mean (ms)':>12}{'% of wall':>11}")
+    for name, (calls, total) in summary().items():
+        print(f"{name:<28}{calls:>10}{total:>12.2f}{total / calls * 1000:>12.2f}{total / wall:>11.1%}")
+    print(f"{'wall':<28}{'':>10}{wall:>12.2f}")
+
+
+def save_trace(trace_path: str):
+    """Write the recorded spans as a Chrome trace (open it in chrome://tracing or ui.perfetto.dev)."""
+    if not _enabled:
+        return
+    os.makedirs(os.path.dirname(trace_path) or ".", exist_ok=True)
+    pid = os.getpid()
+    trace_events = [
+        {"name": name, "ph": "X", "ts": (begin - _start) * 1e6, "dur": duration * 1e6, "pid": pid, "tid": tid}
+        for name, begin, duration, tid in _events
+    ]
+    with open(trace_path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+    print(f"Trace saved to {trace_path}")
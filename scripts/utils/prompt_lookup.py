@@ -0,0 +1,55 @@
+import torch
+from transformers.generation.candidate_generator import CandidateGenerator
+
+
+class DraftLookupCandidateGenerator(CandidateGenerator):
+    """
+    Prompt-lookup drafting from a reference text instead of the prompt, for the drafted decoding of
+    Qwen2_5VLBatchInferencer._draft_generate.
+
+    The last `max_ngram_size` (down to 1) generated tokens are looked up in the tokenized reference, e.g.
+    the ground truth of an OCR answer, from the end of the previous draft on, and the `num_draft_tokens`
+    tokens following the match are proposed as the draft. The model verifies the whole draft in one forward
+    pass and keeps its own tokens from the first disagreement on, so the answer is the one plain decoding
+    gives, in fewer forward passes.
+    """
+    def __init__(self, draft_ids, prompt_length, max_length, num_draft_tokens=10, max_ngram_size=3):
+        self.draft_ids = draft_ids
+        self.prompt_length = prompt_length
+        self.max_length = max_length
+        self.num_draft_tokens = num_draft_tokens
+        self.max_ngram_size = max_ngram_size
+        # position in draft_ids after the previous draft, so that repeated words follow the order of the reference
+        self.cursor = 0
+        # target forward passes and draft tokens they accepted
+        self.steps = 0
+        self.accepted = 0
+
+    def _lookup(self, generated):
+        if not self.draft_ids:
+            return None
+        if not generated:
+            # the answer usually starts like the reference
+            return 0
+        starts = [*range(self.cursor, len(self.draft_ids)), *range(self.cursor)]
+        for ngram_size in range(min(self.max_ngram_size, len(generated)), 0, -1):
+            ngram = generated[-ngram_size:]
+            for start in starts:
+                if self.draft_ids[start:start + ngram_size] == ngram and start + ngram_size < len(self.draft_ids):
+                    return start + ngram_size
+        return None
+
+    def get_candidates(self, input_ids):
+        # the verification pass also generates one token, which must fit in max_length
+        room = min(self.max_length - input_ids.shape[1] - 1, self.num_draft_tokens)
+        start = self._lookup(input_ids[0, self.prompt_length:].tolist())
+        if start is None or room <= 0:
+            return input_ids, None
+        draft = self.draft_ids[start:start + room]
+        self.cursor = start + len(draft)
+        draft = torch.tensor([draft], dtype=input_ids.dtype, device=input_ids.device)
+        return torch.cat((input_ids, draft), dim=1), None
+
+    def update_candidate_strategy(self, input_ids, scores, num_matches):
+        self.steps += 1
+        self.accepted += num_matches
@@ -0,0 +1,77 @@
+import torch
+from collections import Counter
+from transformers import StoppingCriteria
+
+# text the VLM emits when it hallucinates instead of reading the image, see clean_and_remove_hallucinations
+HALLUCINATION_MARKERS = ["addCriterion"]
+
+
+def is_repeating(tokens, max_period=16, min_repeats=4, min_span=24):
+    """Whether the tokens end with a block of at most `max_period` tokens repeated over the last max(period * min_repeats, min_span) tokens."""
+    for period in range(1, max_period + 1):
+        span = max(period * min_repeats, min_span)
+        if len(tokens) < span:
+            continue
+        tail = tokens[-span:]
+        if tail[period:] == tail[:-period]:
+            return True
+    return False
+
+
+class OCRStoppingCriteria(StoppingCriteria):
+    """
+    Stop each OCR answer of a generation batch as soon as one of `policies` applies:
+
+    - length: the answer, normalized by `normalize`, is longer than its max_chars,
+    - repetition: the answer loops over the same few tokens,
+    - hallucination: the answer contains one of HALLUCINATION_MARKERS.
+
+    The policies are lossy: a stopped answer lacks the text the model would still have generated, e.g.
+    the text after a hallucination marker. Answers are decoded every `check_every` tokens for the length
+    and hallucination policies, so they may run a few tokens past the limit. The policy and step at which
+    each answer stopped are kept in `stopped`.
+    """
+    def __init__(self, tokenizer, prompt_length, policies, max_chars, finished_token_ids, normalize=None, check_every=4):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.policies = policies
+        self.max_chars = max_chars
+        self.finished_token_ids = set(finished_token_ids)
+        self.normalize = normalize or (lambda text: text)
+        self.check_every = check_every
+        self.stopped = [None] * len(max_chars)
+        # answer lengths at the last decoding; assisted generation may add several tokens per step
+        self.decoded_lengths = [0] * len(max_chars)
+
+    def _stop_reason(self, idx, tokens):
+        if "repetition" in self.policies and is_repeating(tokens):
+            return "repetition"
+        if len(tokens) < self.decoded_lengths[idx] + self.check_every:
+            return None
+        self.decoded_lengths[idx] = len(tokens)
+        text = self.tokenizer.decode(tokens, skip_special_tokens=True)
+        if "hallucination" in self.policies and any(marker in text for marker in HALLUCINATION_MARKERS):
+            return "hallucination"
+        if "length" in self.policies and self.max_chars[idx] is not None and len(self.normalize(text)) > self.max_chars[idx]:
+            return "length"
+        return None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = [False] * input_ids.shape[0]
+        for idx, tokens in enumerate(input_ids[:, self.prompt_length:].tolist()):
+            if self.stopped[idx] is None and not self.finished_token_ids.intersection(tokens):
+                reason = self._stop_reason(idx, tokens)
+                if reason is not None:
+                    self.stopped[idx] = (reason, len(tokens))
+            done[idx] = self.stopped[idx] is not None
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+    def tokens_saved(self, max_new_tokens):
+        """Per policy, the number of answers it stopped and the tokens they could still have generated."""
+        stats = Counter()
+        for stopped in self.stopped:
+            if stopped is not None:
+                reason, num_tokens = stopped
+                stats[f"{reason} answers"] += 1
+                stats[f"{reason} tokens saved (max)"] += max_new_tokens - num_tokens
+        return stats
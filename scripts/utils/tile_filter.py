@@ -0,0 +1,118 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+import megfile
+
+TILE_OK = "ok"
+TILE_BLACK = "black"
+TILE_UNIFORM = "uniform"
+TILE_CORRUPT = "corrupt"
+TILE_DUPLICATE = "duplicate"
+TILE_STATUSES = [TILE_OK, TILE_BLACK, TILE_UNIFORM, TILE_CORRUPT, TILE_DUPLICATE]
+
+
+def classify_tiles(grid_array, grid_size, uniform_tolerance: int = 4, detect_black: bool = True):
+    """
+    Classify every tile of a decoded grid in one vectorized pass.
+
+    Tiles use the same boxes and row-major order as split_2x2_grid. A tile is "black" when every
+    pixel is (0, 0, 0) (the padding written by text2image.py), "uniform" when no channel varies by
+    more than `uniform_tolerance`, and "duplicate" when it is byte-identical to an earlier tile.
+
+    Args:
+        grid_array: (height, width[, channels]) uint8 array of the grid image
+        grid_size: (columns, rows) of the grid
+        detect_black: Label all-zero tiles "black"; without it they are labelled like any other tile
+
+    Returns:
+        One status per tile
+    """
+    if grid_array.ndim == 2:
+        grid_array = grid_array[:, :, None]
+    columns, rows = grid_size
+    tile_height = grid_array.shape[0] // rows
+    tile_width = grid_array.shape[1] // columns
+    channels = grid_array.shape[2]
+
+    tiles = grid_array[:rows * tile_height, :columns * tile_width]
+    tiles = tiles.reshape(rows, tile_height, columns, tile_width, channels).swapaxes(1, 2)
+    tiles = tiles.reshape(rows * columns, tile_height * tile_width, channels)
+
+    tile_max = tiles.max(axis=1)
+    tile_min = tiles.min(axis=1)
+    is_black = (tile_max == 0).all(axis=1)
+    is_uniform = ((tile_max.astype(np.int16) - tile_min) <= uniform_tolerance).all(axis=1)
+
+    statuses = []
+    seen = set()
+    for idx in range(len(tiles)):
+        if detect_black and is_black[idx]:
+            statuses.append(TILE_BLACK)
+            continue
+        digest = hashlib.blake2b(np.ascontiguousarray(tiles[idx]), digest_size=16).digest()
+        if digest in seen:
+            statuses.append(TILE_DUPLICATE)
+        elif is_uniform[idx]:
+            statuses.append(TILE_UNIFORM)
+        else:
+            statuses.append(TILE_OK)
+        seen.add(digest)
+    return statuses
+
+
+class TileManifest:
+    """
+    Append-only JSONL record of tile statuses per grid image, shared by the scorers of a run.
+
+    A record is reused only while the image keeps the same size and mtime, so later scorers
+    skip invalid tiles (and fully invalid grids) without decoding or re-checking them. Sizes
+    and mtimes come from `image_manifest` when the image was listed there, without a stat call.
+    """
+    def __init__(self, path: str, image_manifest=None):
+        self.path = path
+        self.image_manifest = image_manifest
+        self.records = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.records[(record["path"], tuple(record["grid"]))] = record
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def _signature(self, image_path):
+        signature = self.image_manifest.signature(image_path) if self.image_manifest is not None else None
+        if signature is not None:
+            return signature
+        stat = megfile.smart_stat(image_path)
+        return [stat.size, stat.mtime]
+
+    def lookup(self, image_path, grid_size):
+        record = self.records.get((image_path, tuple(grid_size)))
+        if record is None or record["signature"] != self._signature(image_path):
+            return None
+        return record["statuses"]
+
+    def record(self, image_path, grid_size, statuses):
+        record = {
+            "path": image_path,
+            "grid": list(grid_size),
+            "signature": self._signature(image_path),
+            "statuses": statuses,
+        }
+        with self.lock:
+            self.records[(image_path, tuple(grid_size))] = record
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def summary(self):
+        counts = {status: 0 for status in TILE_STATUSES}
+        for record in self.records.values():
+            for status in record["statuses"]:
+                counts[status] += 1
+        return counts
@@ -1,21 +1,60 @@
+import io
 import os
 import stat
+import shutil
+import pickle
+import hashlib
 import megfile
 import argparse
+import numpy as np
 import pandas as pd
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
+from scripts.utils.tile_filter import classify_tiles, TileManifest, TILE_STATUSES, TILE_CORRUPT
+from scripts.utils.profiler import span, profiled
 
-def parse_args():
-    parser = argparse.ArgumentParser(description="Run alignment score evaluation.")
+def build_parser(description="Run alignment score evaluation."):
+    parser = argparse.ArgumentParser(description=description)
     parser.add_argument("--mode", type=str, default="EN", help="Choose language mode (EN/ZH).")
     parser.add_argument("--image_dirname", type=str, default="organized_images", help="Base directory containing organized images.")
     parser.add_argument("--model_names", type=str, nargs="+", default=["gpt-4o"], help="List of model names.")
     parser.add_argument("--image_grid", type=int, nargs="+", default=[2], help="List of image grids.")
     parser.add_argument("--image_type", type=str, default="non-grids", help="Image type: 'grids' or 'non-grids'.")
     parser.add_argument("--checkpoint", type=str, default="15000", help="Checkpoint number (e.g., '15000').")
+    parser.add_argument("--checkpoints", type=str, nargs="+", default=None, help="Evaluate several checkpoints in one run (overrides --checkpoint); results are labelled 'model@checkpoint'.")
     parser.add_argument("--class_items", type=str, nargs="+", default=["anime", "human", "object"], help="List of class items.")
-    return parser.parse_args()
+    parser.add_argument("--batch_size", type=int, default=64, help="Number of (question, tile) pairs per VLM forward batch in alignment scoring.")
+    parser.add_argument("--ocr_batch_size", type=int, default=16, help="Number of tiles per OCR generation batch; tiles of several prompts and models with a similar expected text length are batched together.")
+    parser.add_argument("--ocr_stopping", type=str, nargs="*", default=[], choices=["length", "repetition", "hallucination"], help="Lossy: stop OCR answers that exceed the ground truth plus the edit distance budget ('length'), loop over repeated tokens ('repetition') or contain hallucination markers ('hallucination'), which drops the rest of their text and changes ED, WAC and the text score; answers run to EOS or max_new_tokens if not set.")
+    parser.add_argument("--ocr_gt_draft", action="store_true", help="Decode OCR answers one tile at a time with greedy decoding that verifies drafts looked up in the ground truth text (prompt lookup), which accepts several tokens per forward pass and gives the answers of plain greedy decoding; drafted answers are cached apart.")
+    parser.add_argument("--ocr_draft_check", action="store_true", help="With --ocr_gt_draft, also decode every tile with plain decoding and report the answers that differ.")
+    parser.add_argument("--scoring", type=str, default="generate", choices=["generate", "logits"], help="Alignment answers from decoded text ('generate') or from Yes/No next-token logits ('logits').")
+    parser.add_argument("--ask_all_questions", action="store_true", help="Ask every alignment question, even children of parents already answered 'No'.")
+    parser.add_argument("--answer_cache", type=str, default=None, help="SQLite file caching VLM answers across runs (alignment and text); disabled if not set.")
+    parser.add_argument("--save_tiles", action="store_true", help="Save tiles as JPEG files in a tmp_ directory and pass file paths to the models, instead of in-memory tiles.")
+    parser.add_argument("--skip_tiles", type=str, nargs="*", default=["black", "corrupt"], choices=TILE_STATUSES[1:], help="Tile statuses that are excluded from scoring.")
+    parser.add_argument("--tile_manifest", type=str, default=None, help="JSONL manifest of tile statuses shared by the scorers of a run, so grids are only checked once.")
+    parser.add_argument("--image_manifest", type=str, default=None, help="JSON file caching the listing (path, size, mtime) of every image directory across runs; directories are listed once per run if not set.")
+    parser.add_argument("--refresh_image_manifest", action="store_true", help="List every image directory again, e.g. after overwriting images in place.")
+    parser.add_argument("--num_shards", type=int, default=1, help="Split the prompts into this many deterministic shards, e.g. one per GPU or node.")
+    parser.add_argument("--shard_id", type=int, default=0, help="Shard evaluated by this process, in [0, num_shards).")
+    parser.add_argument("--records_dir", type=str, default="results/records", help="Directory of the per-prompt result records, which scripts.merge combines across shards.")
+    parser.add_argument("--resume", action="store_true", help="Keep the per-prompt records already in --records_dir and only score the missing prompts.")
+    parser.add_argument("--work_queue", type=str, default=None, help="SQLite work queue shared by several worker processes or hosts, which lease prompts from it instead of using static shards.")
+    parser.add_argument("--queue_lease", type=float, default=3600, help="Seconds after which a prompt leased by an unresponsive worker is handed out again.")
+    parser.add_argument("--queue_max_attempts", type=int, default=3, help="Number of times a failing prompt is retried before it is marked as failed.")
+    parser.add_argument("--profile", action="store_true", help="Time every stage (read, decode, split, preprocessing, generation, metrics, writers), print a summary table and save a Chrome trace.")
+    parser.add_argument("--profile_trace", type=str, default=None, help="Path of the Chrome trace JSON written with --profile (default: results/trace_<mode>_<time>.json).")
+    parser.add_argument("--plan", action="store_true", help="Only count the grids, valid tiles and model calls of the run and estimate its duration from past runs, without loading any model.")
+    parser.add_argument("--throughput_log", type=str, default="cache/throughput.jsonl", help="JSONL file where every run records its throughput per metric, used by --plan to estimate durations.")
+    parser.add_argument("--prefetch", type=int, default=0, help="Number of grids fetched, decoded and split ahead of the scoring loop in background threads (0 disables).")
+    parser.add_argument("--prefetch_workers", type=int, default=2, help="Number of background threads used by --prefetch.")
+    parser.add_argument("--prompts_per_batch", type=int, default=1, help="Number of prompt grids whose (question, tile) pairs are flattened into shared batches.")
+    parser.add_argument("--cross_model_batch", action="store_true", help="Batch the grids of every model and checkpoint for the same prompt together; --prompts_per_batch then counts prompts.")
+    return parser
+
+def parse_args():
+    return build_parser().parse_args()
 
 
 def get_image_path(base_dir: str, model_name: str, image_type: str, checkpoint: str, mode: str, category: str = None) -> str:
@@ -41,49 +80,166 @@ def get_image_path(base_dir: str, model_name: str, image_type: str, checkpoint:
     else:
         return os.path.join(base_dir, model_name, image_type, checkpoint, language)
 
+def get_eval_targets(args):
+    """
+    Expand --model_names and --checkpoints into the list of evaluated targets.
+
+    With a single checkpoint the label is the plain model name, so result CSVs keep their usual columns.
+
+    Returns:
+        List of (label, model_name, checkpoint, image_grid) tuples
+    """
+    checkpoints = args.checkpoints or [args.checkpoint]
+    targets = []
+    for model_id, model_name in enumerate(args.model_names):
+        img_grid = (args.image_grid[model_id], args.image_grid[model_id])
+        for checkpoint in checkpoints:
+            label = model_name if len(checkpoints) == 1 else f"{model_name}@{checkpoint}"
+            targets.append((label, model_name, checkpoint, img_grid))
+    return targets
+
+def load_tile_manifest(args, image_manifest=None):
+    return TileManifest(args.tile_manifest, image_manifest) if args.tile_manifest else None
+
+def tile_hash(image):
+    """Content hash of a tile given as a file path or an in-memory PIL image."""
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(image, str):
+        with megfile.smart_open(image, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    else:
+        digest.update(f"{image.mode}:{image.size}".encode())
+        digest.update(image.tobytes())
+    return digest.hexdigest()
+
 def is_black_image(image):
-    pixels = image.load()  
-    for i in range(image.width):
-        for j in range(image.height):
-            if pixels[i, j] != (0, 0, 0):
-                return False
-    return True
+    # like the original per-pixel comparison with (0, 0, 0), only RGB images can be black
+    return image.mode == "RGB" and not np.asarray(image).any()
 
-def split_2x2_grid(image_path, grid_size, cache_dir):
-    with megfile.smart_open(image_path, 'rb') as f:
-        grid_image = Image.open(f)
+def open_image(image):
+    """Accept a tile as a file path or an in-memory PIL image."""
+    if isinstance(image, str):
+        return Image.open(image)
+    return image
 
-        width, height = grid_image.size
+def split_2x2_grid(image_path, grid_size, cache_dir=None, skip_tiles=("black", "corrupt"), tile_manifest=None):
+    """
+    Crop a grid image into its tiles, skipping invalid tiles (pure black padding by default).
+
+    Tile validity comes from `tile_manifest` when the grid was already checked in this run, and is
+    otherwise computed with classify_tiles and recorded there. Tiles are returned in memory as PIL
+    images. When `cache_dir` is given, they are additionally saved there as JPEG files and the file
+    paths are returned instead.
+    """
+    num_tiles = grid_size[0] * grid_size[1]
+    statuses = tile_manifest.lookup(image_path, grid_size) if tile_manifest is not None else None
+    if statuses is not None and all(status in skip_tiles for status in statuses):
+        return []
 
-        individual_width = width // grid_size[0]
-        individual_height = height // grid_size[1]
+    try:
+        with span("grid/read"):
+            with megfile.smart_open(image_path, 'rb') as f:
+                data = f.read()
+        with span("grid/decode"):
+            grid_image = Image.open(io.BytesIO(data))
+            grid_image.load()
+    except Exception as e:
+        print(f"Failed to decode {image_path}: {e}")
+        if tile_manifest is not None:
+            tile_manifest.record(image_path, grid_size, [TILE_CORRUPT] * num_tiles)
+        if TILE_CORRUPT in skip_tiles:
+            return []
+        raise
 
-        image_list = []
+    if statuses is None:
+        with span("grid/validity"):
+            grid_array = np.asarray(grid_image if grid_image.mode in ("RGB", "L") else grid_image.convert("RGB"))
+            # as in is_black_image, only tiles of RGB grids can be black padding
+            statuses = classify_tiles(grid_array, grid_size, detect_black=grid_image.mode == "RGB")
+        if tile_manifest is not None:
+            tile_manifest.record(image_path, grid_size, statuses)
 
-        for i in range(grid_size[1]):
-            for j in range(grid_size[0]):
-                box = (
-                    j * individual_width,      
-                    i * individual_height,     
-                    (j + 1) * individual_width,  
-                    (i + 1) * individual_height  
-                )
+    width, height = grid_image.size
 
-                individual_image = grid_image.crop(box)
+    individual_width = width // grid_size[0]
+    individual_height = height // grid_size[1]
 
-                if is_black_image(individual_image):
-                    print(f"Detected a black image at position ({i},{j}) in {image_path}")
-                else:
-                    image_list.append(individual_image)
+    image_list = []
+
+    for i in range(grid_size[1]):
+        for j in range(grid_size[0]):
+            status = statuses[i * grid_size[0] + j]
+            if status in skip_tiles:
+                print(f"Detected a {status} image at position ({i},{j}) in {image_path}")
+                continue
+
+            box = (
+                j * individual_width,      
+                i * individual_height,     
+                (j + 1) * individual_width,  
+                (i + 1) * individual_height  
+            )
+
+            with span("grid/split"):
+                image_list.append(grid_image.crop(box))
+
+    if cache_dir is None:
+        return image_list
 
     image_path_list = []
-    for i, image in enumerate(image_list):
-        image_path = os.path.join(cache_dir, f"{i}.jpg")
-        image.save(image_path)
-        image_path_list.append(image_path)
+    with span("grid/save_tiles"):
+        for i, image in enumerate(image_list):
+            image_path = os.path.join(cache_dir, f"{i}.jpg")
+            image.save(image_path)
+            image_path_list.append(image_path)
 
     return image_path_list
 
+def load_compiled(source_path, artifact_path, build_fn):
+    """
+    Load an artifact compiled from `source_path`, rebuilding it only when the source changes.
+
+    Args:
+        source_path: Source file (e.g., a Q_D json or text_content.csv)
+        artifact_path: Pickle file holding the compiled artifact
+        build_fn: Called as build_fn(source_path) to (re)compile the artifact
+
+    Returns:
+        The compiled artifact
+    """
+    source_stat = os.stat(source_path)
+    signature = (source_stat.st_size, source_stat.st_mtime_ns)
+    if os.path.exists(artifact_path):
+        try:
+            with open(artifact_path, "rb") as f:
+                cached = pickle.load(f)
+            if cached["signature"] == signature:
+                return cached["data"]
+        except Exception as e:
+            print(f"Rebuilding {artifact_path}: {e}")
+
+    data = build_fn(source_path)
+    os.makedirs(os.path.dirname(artifact_path) or ".", exist_ok=True)
+    tmp_path = f"{artifact_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump({"signature": signature, "data": data}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, artifact_path)
+    return data
+
+def make_grid_cache_dir(cache_dir, name):
+    """Create a tile directory for one grid, so that grids split ahead of time do not overwrite each other."""
+    if cache_dir is None:
+        return None
+    grid_cache_dir = os.path.join(cache_dir, name)
+    os.makedirs(grid_cache_dir, exist_ok=True)
+    return grid_cache_dir
+
+def remove_grid_cache_dir(cache_dir, name):
+    if cache_dir is not None and os.path.exists(os.path.join(cache_dir, name)):
+        shutil.rmtree(os.path.join(cache_dir, name), onerror=on_rm_error)
+
+@profiled("write/csv")
 def save2csv(df, csv_path):
     df.to_csv(csv_path)
     print(f"Results saved to {csv_path}")
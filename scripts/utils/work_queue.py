@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+
+
+class WorkQueue:
+    """
+    SQLite-backed queue of prompt-level tasks that several evaluation workers drain together.
+
+    A task is one prompt id of one category, scored for every evaluated model. Workers lease the most
+    expensive pending tasks first; a lease that is not completed within `lease_seconds` (e.g. the
+    worker was killed) expires and the task is handed out again, and a task that raised is retried
+    until it failed `max_attempts` times. The per-prompt records of finished tasks are stored in the
+    queue, so the result CSVs can be built once every task is done.
+
+    The default rollback journal is used instead of WAL, so the file can be shared by hosts that
+    mount the same filesystem (which must support POSIX locks).
+
+    The first worker records the `fingerprint` of its run settings (see pipeline.run_fingerprint), and
+    workers with other settings are refused, so that their records never mix in the same results.
+    """
+    def __init__(self, path: str, lease_seconds: float = 3600, max_attempts: int = 3, fingerprint: dict = None):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=300, isolation_level=None)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "id TEXT PRIMARY KEY, category TEXT NOT NULL, key TEXT NOT NULL, cost REAL NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+            "worker TEXT, lease_expires REAL, error TEXT)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS tasks_claim ON tasks (category, status, cost)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS records (task TEXT NOT NULL, metric TEXT NOT NULL, record TEXT NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS records_task ON records (task)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        if fingerprint is not None:
+            self.conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('run_fingerprint', ?)", (json.dumps(fingerprint, sort_keys=True),))
+            queue_fingerprint = json.loads(self.conn.execute("SELECT value FROM meta WHERE name = 'run_fingerprint'").fetchone()[0])
+            if queue_fingerprint != fingerprint:
+                self.conn.close()
+                raise ValueError(f"{path} is a work queue of a run with other settings ({queue_fingerprint}); use another --work_queue file.")
+
+    @staticmethod
+    def task_id(category, key):
+        return f"{category}/{key}"
+
+    def add_tasks(self, category, costs):
+        """Register the prompts of a category as {key: cost}; tasks that already exist are left untouched."""
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO tasks (id, category, key, cost) VALUES (?, ?, ?, ?)",
+            [(self.task_id(category, key), category, key, cost) for key, cost in costs.items()],
+        )
+
+    def claim(self, category, limit: int = 1):
+        """Lease up to `limit` runnable tasks of a category, most expensive first, and return their keys."""
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            # expired leases that already used up their attempts will not be handed out again
+            self.conn.execute(
+                "UPDATE tasks SET status = 'failed', error = 'lease expired' WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+            rows = self.conn.execute(
+                "SELECT id, key FROM tasks WHERE category = ? AND attempts < ? "
+                "AND (status = 'pending' OR (status = 'leased' AND lease_expires < ?)) "
+                "ORDER BY cost DESC, id LIMIT ?",
+                (category, self.max_attempts, now, limit),
+            ).fetchall()
+            self.conn.executemany(
+                "UPDATE tasks SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                [(self.worker, now + self.lease_seconds, id) for id, _ in rows],
+            )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return [key for _, key in rows]
+
+    def complete(self, category, keys, records):
+        """Mark leased tasks as done and store their records, given as {metric: [record, ...]}."""
+        task_ids = [self.task_id(category, key) for key in keys]
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.executemany("DELETE FROM records WHERE task = ?", [(id,) for id in task_ids])
+            self.conn.executemany(
+                "INSERT INTO records (task, metric, record) VALUES (?, ?, ?)",
+                [
+                    (self.task_id(category, record["key"]), metric, json.dumps(record, ensure_ascii=False))
+                    for metric, metric_records in records.items() for record in metric_records
+                ],
+            )
+            self.conn.executemany("UPDATE tasks SET status = 'done', lease_expires = NULL, error = NULL WHERE id = ?", [(id,) for id in task_ids])
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def fail(self, category, keys, error):
+        """Give leased tasks back for a retry, or mark them failed once they used up their attempts."""
+        self.conn.executemany(
+            "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "lease_expires = NULL, error = ? WHERE id = ?",
+            [(self.max_attempts, str(error), self.task_id(category, key)) for key in keys],
+        )
+
+    def counts(self):
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        counts.update(self.conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+        return counts
+
+    def is_drained(self):
+        """True once no task is pending or leased."""
+        counts = self.counts()
+        return counts["pending"] == 0 and counts["leased"] == 0
+
+    def save_categories(self, metric, categories):
+        """Record the categories of a metric, in the order its results are written, for scripts.merge."""
+        self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (f"categories/{metric}", json.dumps(categories)))
+
+    def load_categories(self, metric):
+        row = self.conn.execute("SELECT value FROM meta WHERE name = ?", (f"categories/{metric}",)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def claim_finalization(self):
+        """Return True for exactly one worker, which then writes the result CSVs."""
+        return self.conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('finalized', ?)", (self.worker,)).rowcount == 1
+
+    def load_records(self, metric):
+        return [json.loads(record) for record, in self.conn.execute("SELECT record FROM records WHERE metric = ?", (metric,))]
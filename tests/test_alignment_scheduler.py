@@ -0,0 +1,101 @@
+import random
+from copy import deepcopy
+
+import numpy as np
+import pytest
+
+from scripts.alignment.alignment_utils import LazyQuestionScheduler, compile_questions, filter_and_average
+
+
+def original_alignment_score(dependencies, score, num_tiles):
+    """The per-question filter of the original alignment_score, on {question id: [answer per tile]}."""
+    filter_score = deepcopy(score)
+    for img_idx in range(num_tiles):
+        for id, parent_ids in dependencies.items():
+            any_parent_answered_no = False
+            for parent_id in parent_ids:
+                if parent_id == 0 or parent_id not in score:
+                    continue
+                if score[parent_id][img_idx] == 0:
+                    any_parent_answered_no = True
+                    break
+            if any_parent_answered_no:
+                filter_score[id][img_idx] = 0
+
+    sum_of_filter_score = [0] * num_tiles
+    for question_id in range(len(filter_score)):
+        for img_idx in range(num_tiles):
+            sum_of_filter_score[img_idx] += filter_score[question_id + 1][img_idx]
+    sum_of_filter_score = [img_score / len(filter_score) for img_score in sum_of_filter_score]
+    return sum(sum_of_filter_score) / len(sum_of_filter_score)
+
+
+def scheduled_alignment_score(entry, score, num_tiles, lazy):
+    """Ask the questions wave by wave like batched_alignment_scores, answering from `score`."""
+    scheduler = LazyQuestionScheduler(entry, num_tiles, lazy)
+    for wave_idx in range(len(scheduler.waves)):
+        for question_idx, tile_idx in scheduler.pending(wave_idx):
+            scheduler.record(question_idx, tile_idx, score[int(entry.ids[question_idx])][tile_idx])
+    assert not np.isnan(scheduler.answers).any()
+    return filter_and_average(entry, scheduler.answers), scheduler
+
+
+GRAPHS = {
+    "chain": {1: [0], 2: [1], 3: [2], 4: [3]},
+    "cycle": {1: [3], 2: [1], 3: [2], 4: [0]},
+    "self_reference": {1: [1], 2: [2, 1], 3: [0], 4: [3, 3]},
+    "multi_parent": {1: [0], 2: [0], 3: [1, 2], 4: [1, 3], 5: [2, 4, 0]},
+    "unknown_parent": {1: [0], 2: [9], 3: [1, 9], 4: [2]},
+    "cycle_with_tail": {1: [0], 2: [1, 3], 3: [2], 4: [3], 5: [4, 1]},
+}
+
+
+def random_answers(questions, num_tiles, p_yes, rng):
+    return {id: [float(rng.random() < p_yes) for _ in range(num_tiles)] for id in questions}
+
+
+@pytest.mark.parametrize("name", sorted(GRAPHS))
+def test_scheduler_matches_original_filter(name):
+    dependencies = GRAPHS[name]
+    questions = {id: f"question {id}" for id in dependencies}
+    entry = compile_questions(questions, dependencies)
+    rng = random.Random(name)
+    for _ in range(200):
+        num_tiles = rng.randint(1, 4)
+        score = random_answers(questions, num_tiles, rng.choice([0.2, 0.5, 0.8]), rng)
+        expected = original_alignment_score(dependencies, score, num_tiles)
+        lazy, _ = scheduled_alignment_score(entry, score, num_tiles, lazy=True)
+        eager, _ = scheduled_alignment_score(entry, score, num_tiles, lazy=False)
+        assert lazy == pytest.approx(expected, abs=1e-12)
+        assert eager == pytest.approx(expected, abs=1e-12)
+
+
+def test_scheduler_matches_original_filter_on_random_graphs():
+    rng = random.Random(0)
+    for _ in range(300):
+        num_questions = rng.randint(1, 8)
+        dependencies = {
+            id: rng.sample(range(0, num_questions + 2), rng.randint(1, 3))
+            for id in range(1, num_questions + 1)
+        }
+        questions = {id: f"question {id}" for id in dependencies}
+        entry = compile_questions(questions, dependencies)
+        num_tiles = rng.randint(1, 4)
+        score = random_answers(questions, num_tiles, rng.random(), rng)
+        expected = original_alignment_score(dependencies, score, num_tiles)
+        lazy, _ = scheduled_alignment_score(entry, score, num_tiles, lazy=True)
+        eager, _ = scheduled_alignment_score(entry, score, num_tiles, lazy=False)
+        assert lazy == pytest.approx(expected, abs=1e-12)
+        assert eager == pytest.approx(expected, abs=1e-12)
+
+
+def test_lazy_scheduler_skips_filtered_children():
+    dependencies = {1: [0], 2: [1], 3: [1], 4: [1]}
+    questions = {id: f"question {id}" for id in dependencies}
+    entry = compile_questions(questions, dependencies)
+    # the root is answered "No" on every tile, so its children need not be asked
+    score = {id: [0.0, 0.0] if id == 1 else [1.0, 1.0] for id in questions}
+    _, lazy = scheduled_alignment_score(entry, score, 2, lazy=True)
+    _, eager = scheduled_alignment_score(entry, score, 2, lazy=False)
+    assert lazy.num_queries == 2 and lazy.num_saved == 6
+    assert eager.num_queries == 8 and eager.num_saved == 0
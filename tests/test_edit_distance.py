@@ -0,0 +1,83 @@
+import random
+
+import pytest
+
+from scripts.text.edit_distance import Pattern, levenshtein, levenshtein_batch, levenshtein_bounded
+
+
+def dp_levenshtein(s1, s2):
+    """Textbook dynamic program, one row at a time."""
+    previous = list(range(len(s2) + 1))
+    for i, c1 in enumerate(s1, 1):
+        current = [i]
+        for j, c2 in enumerate(s2, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (c1 != c2)))
+        previous = current
+    return previous[-1]
+
+
+EDGE_CASES = [
+    ("", ""),
+    ("", "abc"),
+    ("abc", ""),
+    ("a", "a"),
+    ("a", "b"),
+    ("kitten", "sitting"),
+    ("flaw", "lawn"),
+    # patterns of 63, 64, 65 and several 64-bit blocks
+    ("a" * 63, "a" * 64),
+    ("ab" * 32, "ba" * 32),
+    ("x" * 65, "x" * 64 + "y"),
+    ("abcdefghij" * 13, "abcdefghij" * 12 + "abcdefghiz"),
+    ("a" * 200, "b" * 200),
+    ("a" * 130 + "b", "b" + "a" * 130),
+    # CJK and characters outside the Basic Multilingual Plane
+    ("中文文本识别", "中文本识别"),
+    ("欢迎光临", "欢迎光临本店"),
+    ("𠀀𠀁𠀂", "𠀀𠀂"),
+    ("😀 ok 😀", "😀 ok"),
+    ("汉字" * 40, "漢字" * 40),
+]
+
+
+@pytest.mark.parametrize("s1, s2", EDGE_CASES)
+def test_levenshtein_edge_cases(s1, s2):
+    expected = dp_levenshtein(s1, s2)
+    assert levenshtein(s1, s2) == expected
+    assert levenshtein(s2, s1) == expected
+    assert levenshtein_batch([s1], s2) == [expected]
+    for max_distance in (0, 1, expected - 1, expected, expected + 1, 500):
+        if max_distance < 0:
+            continue
+        assert levenshtein_bounded(s1, s2, max_distance) == min(expected, max_distance + 1)
+
+
+def random_text(rng, alphabet, max_length):
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(0, max_length)))
+
+
+@pytest.mark.parametrize("alphabet, max_length", [
+    ("ab", 20),
+    ("abc d", 80),
+    ("中文字符 ab", 150),
+    ("𠀀𠀁😀a", 70),
+])
+def test_levenshtein_matches_dp_on_random_strings(alphabet, max_length):
+    rng = random.Random(f"{alphabet}{max_length}")
+    for _ in range(300):
+        s1 = random_text(rng, alphabet, max_length)
+        s2 = random_text(rng, alphabet, max_length)
+        expected = dp_levenshtein(s1, s2)
+        assert levenshtein(s1, s2) == expected, (s1, s2)
+        max_distance = rng.randint(0, max_length)
+        assert levenshtein_bounded(s1, s2, max_distance) == min(expected, max_distance + 1), (s1, s2, max_distance)
+
+
+def test_levenshtein_batch_reuses_one_pattern():
+    rng = random.Random(0)
+    reference = random_text(rng, "abc中文", 100)
+    texts = [random_text(rng, "abc中文", 100) for _ in range(50)]
+    expected = [dp_levenshtein(text, reference) for text in texts]
+    assert levenshtein_batch(texts, reference) == expected
+    assert levenshtein_batch(texts, Pattern(reference)) == expected
+    assert levenshtein_batch(texts, reference, max_distance=10) == [min(distance, 11) for distance in expected]
@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+from scripts.utils.pipeline import RecordLog, read_records
+
+FINGERPRINT = {"mode": "EN", "targets": [["model", "model", "", [2, 2]]], "scoring": "generate"}
+CATEGORIES = ["anime", "human"]
+PROMPTS = [(category, f"{key:03d}", label) for category in CATEGORIES for key in range(10) for label in ("a", "b")]
+
+
+def score(record_log, prompts):
+    """Record every prompt that is not done yet, one record at a time like run_scorers."""
+    scored = []
+    for category, key, label in prompts:
+        if (category, key, label) in record_log.done:
+            continue
+        record_log.append([{"category": category, "key": key, "label": label, "score": len(key)}])
+        scored.append((category, key, label))
+    return scored
+
+
+def test_resume_after_a_record_cut_short(tmp_path):
+    path = str(tmp_path / "records.jsonl")
+    record_log = RecordLog(path, fingerprint=FINGERPRINT, categories=CATEGORIES)
+    score(record_log, PROMPTS[:15])
+    record_log.close()
+
+    # the run crashes while writing the 16th record
+    with open(path, "rb") as f:
+        complete = f.read()
+    partial = b'{"category": "anime", "key": "007", "lab'
+    with open(path, "wb") as f:
+        f.write(complete + partial)
+
+    record_log = RecordLog(path, resume=True, fingerprint=FINGERPRINT, categories=CATEGORIES)
+    assert record_log.done == set(PROMPTS[:15])
+    scored = score(record_log, PROMPTS)
+    record_log.close()
+    assert scored == PROMPTS[15:]
+
+    header, records = read_records(path)
+    assert header == {"run_fingerprint": FINGERPRINT, "categories": CATEGORIES}
+    assert [(record["category"], record["key"], record["label"]) for record in records] == PROMPTS
+    # the partial line was dropped, not left in the middle of the log
+    with open(path, "r", encoding="utf-8") as f:
+        assert len(f.readlines()) == 1 + len(PROMPTS)
+
+
+def test_resume_refuses_other_settings(tmp_path):
+    path = str(tmp_path / "records.jsonl")
+    record_log = RecordLog(path, fingerprint=FINGERPRINT, categories=CATEGORIES)
+    score(record_log, PROMPTS[:3])
+    record_log.close()
+
+    with pytest.raises(ValueError):
+        RecordLog(path, resume=True, fingerprint={**FINGERPRINT, "scoring": "logits"}, categories=CATEGORIES)
+    # the refused log is left untouched
+    assert len(read_records(path)[1]) == 3
+
+
+def test_without_resume_the_log_starts_empty(tmp_path):
+    path = str(tmp_path / "records.jsonl")
+    record_log = RecordLog(path, fingerprint=FINGERPRINT, categories=CATEGORIES)
+    score(record_log, PROMPTS[:3])
+    record_log.close()
+
+    record_log = RecordLog(path, fingerprint=FINGERPRINT, categories=CATEGORIES)
+    assert record_log.done == set()
+    record_log.close()
+    assert read_records(path)[1] == []
+
+
+@pytest.mark.skipif(os.name == "nt", reason="record logs are only locked on POSIX systems")
+def test_a_log_is_written_by_one_run_at_a_time(tmp_path):
+    path = str(tmp_path / "records.jsonl")
+    record_log = RecordLog(path, fingerprint=FINGERPRINT, categories=CATEGORIES)
+    with pytest.raises(RuntimeError):
+        RecordLog(path, resume=True, fingerprint=FINGERPRINT, categories=CATEGORIES)
+    record_log.close()